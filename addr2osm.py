@@ -3,23 +3,38 @@
 
 # addr2osm.py
 # Loads addresses from Kartverket and creates an osm file with updates, alternatively uploads to OSM.
-# Usage: "python addr2osm.py <municipality id or county id> [-manual|-upload]".
+# Usage: "python addr2osm.py <municipality id or county id> [-manual|-upload] [-jobs <n>] [-offline] [-pbf <file>] [-country] [-discard]".
 # Optional "-upload" parameter will ask for username/password and upload to OSM,
 # otherwise saves address changes to file with added DELETE tag + include surplus addr objects.
+# Optional "-jobs" parameter will process n municipalities concurrently for county or country.
+# Optional "-offline" parameter will use cached files only (or corrections included with addr2osm).
+# Optional "-pbf" parameter will load OSM addresses from a local OSM extract (requires pyosmium and shapely).
+# Optional "-country" parameter will load OSM addresses for the entire country (00) in one Overpass query (requires shapely).
+# Optional "-discard" parameter will drop changes of an interrupted upload instead of uploading them with "-upload".
 
 
 import json
 import urllib.request, urllib.parse, urllib.error
 import zipfile
-from io import BytesIO, TextIOWrapper
+from io import TextIOWrapper, StringIO
 import os.path
 import sys
 import csv
 import math
 import time
-import copy
-from itertools import tee
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import shutil
+import hashlib
+import atexit
+import importlib.util
+import multiprocessing
+import threading
+import queue
+from array import array
 from xml.etree import ElementTree as ET
+from addr2osm_http import http_open
+from addr2osm_extract import load_pbf, partition_osm_data, get_partition, single_partition, boundary_polygon
 
 
 version = "2.2.0"
@@ -34,7 +49,17 @@ request_header = {"User-Agent": "addr2osm/" + version}
 
 max_retries = 6
 
-changeset_area = "county"  # Changeset partiion - "county" or "municipality". Note max 9900 changeset size.
+changeset_area = "county"  # Changeset partiion - "county" or "municipality". Larger changes are split into several changesets.
+
+max_changeset_size = 9900  # Max number of elements per changeset (OSM API limit is 10.000)
+
+resume_filename = "upload_resume.json"  # Parts of changes not yet uploaded, for resuming interrupted upload
+
+upload_queue_size = 1  # Max number of changesets waiting for background upload while next county/municipality is processed
+
+upload_wait = 60  # Seconds to wait before loading OSM data again, until Overpass includes changes uploaded in the background
+
+max_upload_waits = 10  # Max number of times to wait for Overpass to include changes uploaded in the background
 
 first_municipality = ""  # Set to 4 digit municipality id to start iteration from a specfic municipality
 
@@ -42,8 +67,20 @@ osm_api = "https://api.openstreetmap.org/api/0.6/"  # Production database
 
 overpass_api = "https://overpass-api.de/api/interpreter"
 
+overpass_slots = 2  # Max number of concurrent Overpass queries in total, across all jobs (Overpass limits slots per IP address)
+
+overpass_combined = False  # Load addresses, parents and children in one combined Overpass query instead of three
+
+osm_snapshot = False  # Keep snapshot of OSM addresses per municipality in cache folder, and only load changes since last run
+
 token_filename = "~/Google Drive/Min disk/diverse/Adresser/addr2osm_token.txt"  # OAuth2 access token for OSM
 
+cache_folder = "cache"  # Folder for cached Kartverket address files, registries and corrections
+
+state_folder = "state"  # Folder for state per municipality after last run, for incremental mode
+
+registry_max_age = 24 * 3600  # Seconds before cached municipality/county registries and corrections are revalidated
+
 
 
 # Compute approximation of distance between two coordinates, in meters.
@@ -59,6 +96,80 @@ def compute_distance (p1, p2):
 
 
 
+# Build grid index of OSM address nodes at given positions in compact columns, for fast proximity search.
+# Cells are at least cell_size meters wide and high, so any node within cell_size meters is in one of the 3x3 neighbour cells.
+# Each cell contains a dict of coordinates keyed by position, to allow fast removal and stable tie breaking.
+
+def build_grid (elements, positions, cell_size):
+
+	max_lat = 0
+	for i in positions:
+		max_lat = max(max_lat, abs(elements['lat'][ i ]))
+
+	lat_size = math.degrees(cell_size / 6371000)
+	lon_size = lat_size / math.cos(math.radians(min(max_lat + 0.1, 89)))  # Margin for points just north of the northernmost node
+
+	grid = {
+		'lat_size': lat_size,
+		'lon_size': lon_size,
+		'cell_size': cell_size,
+		'cells': {}
+	}
+
+	for i in positions:
+		point = (elements['lon'][ i ], elements['lat'][ i ])
+		cell = grid_cell(grid, point)
+		if cell not in grid['cells']:
+			grid['cells'][ cell ] = {}
+		grid['cells'][ cell ][ i ] = point
+
+	return grid
+
+
+
+# Return grid cell for coordinate.
+# Format: (lon, lat)
+
+def grid_cell (grid, point):
+
+	return (int(math.floor(point[0] / grid['lon_size'])), int(math.floor(point[1] / grid['lat_size'])))
+
+
+
+# Return position of nearest node in grid closer than cell_size meters, or None if not found.
+# Ties are resolved to the first position.
+
+def grid_nearest (grid, point):
+
+	best_distance = grid['cell_size']
+	best_index = None
+	lon_cell, lat_cell = grid_cell(grid, point)
+
+	for lon_step in [-1, 0, 1]:
+		for lat_step in [-1, 0, 1]:
+			cell = (lon_cell + lon_step, lat_cell + lat_step)
+			if cell in grid['cells']:
+				for i, node_point in grid['cells'][ cell ].items():
+					distance = compute_distance(point, node_point)
+					if distance < best_distance or distance == best_distance and best_index is not None and i < best_index:
+						best_distance = distance
+						best_index = i
+
+	return best_index
+
+
+
+# Remove node at position in compact columns from grid. Must be done before coordinates are modified.
+
+def grid_remove (grid, elements, index):
+
+	cell = grid_cell(grid, (elements['lon'][ index ], elements['lat'][ index ]))
+	del grid['cells'][ cell ][ index ]
+	if not grid['cells'][ cell ]:
+		del grid['cells'][ cell ]
+
+
+
 # Open file/api, try up to 5 times, each time with double sleep time
 
 def open_url (url):
@@ -66,7 +177,7 @@ def open_url (url):
 	tries = 0
 	while tries < max_retries:
 		try:
-			return urllib.request.urlopen(url)
+			return http_open(url)
 		except urllib.error.HTTPError as e:
 			if e.code in [429, 503, 504]:  # Too many requests, Service unavailable or Gateway timed out
 				if tries  == 0:
@@ -90,6 +201,278 @@ def open_url (url):
 
 
 
+# Load file from url into cache folder and return filename of cached file.
+# Cached file is revalidated with ETag/Last-Modified, unless it is younger than max_age seconds or in offline mode.
+# With a fallback file, HTTP and network errors are not fatal: The cached file, or else the fallback file, is used instead.
+
+def load_cached_file (url, filename, max_age=None, fallback=None):
+
+	cache_filename = os.path.join(cache_folder, filename)
+	meta_filename = cache_filename + ".json"
+
+	if os.path.isfile(cache_filename):
+		if offline or max_age is not None and time.time() - os.path.getmtime(cache_filename) < max_age:
+			return cache_filename
+	elif offline:
+		if fallback:
+			return fallback
+		message ("\n")
+		sys.exit("*** File '%s' not found in cache, cannot run offline\n" % cache_filename)
+
+	header = request_header.copy()
+	if os.path.isfile(cache_filename) and os.path.isfile(meta_filename):
+		file = open(meta_filename)
+		meta = json.load(file)
+		file.close()
+		if "etag" in meta:
+			header['If-None-Match'] = meta['etag']
+		if "last_modified" in meta:
+			header['If-Modified-Since'] = meta['last_modified']
+
+	request = urllib.request.Request(url, headers=header)
+	error = None
+	try:
+		if fallback:
+			file_in = http_open(request)  # No retries
+		else:
+			file_in = open_url(request)
+	except urllib.error.HTTPError as e:
+		if e.code == 304:  # Not modified
+			os.utime(cache_filename)  # Restart max_age
+			return cache_filename
+		if not fallback:
+			raise
+		error = "HTTP error %i" % e.code
+	except urllib.error.URLError:  # No network
+		if not os.path.isfile(cache_filename) and not fallback:
+			raise
+		error = "no network"
+
+	if error:
+		if os.path.isfile(cache_filename):
+			message ("\t*** Could not load '%s' (%s), using cached file\n" % (filename, error))
+			return cache_filename
+		message ("\t*** Could not load '%s' (%s), using file included with addr2osm\n" % (filename, error))
+		return fallback
+
+	# Save to temporary file first, to avoid partial files in cache
+
+	os.makedirs(cache_folder, exist_ok=True)
+	temp_filename = "%s.%i.tmp" % (cache_filename, os.getpid())
+	file_out = open(temp_filename, "wb")
+	shutil.copyfileobj(file_in, file_out)
+	file_out.close()
+	os.replace(temp_filename, cache_filename)
+
+	meta = {}
+	if file_in.headers.get("ETag"):
+		meta['etag'] = file_in.headers.get("ETag")
+	if file_in.headers.get("Last-Modified"):
+		meta['last_modified'] = file_in.headers.get("Last-Modified")
+	file_in.close()
+
+	file = open(meta_filename, "w")
+	json.dump(meta, file)
+	file.close()
+
+	return cache_filename
+
+
+
+# Load Overpass query and return json data.
+# Optionally retry up to 5 times if the result is empty (load could be empty from Overpass).
+
+def load_overpass (query, retry_empty=False):
+
+	count = 0
+	data = { 'elements': [] }
+	while not data['elements'] and count < (5 if retry_empty else 1):
+		request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
+		with overpass_semaphore:  # Shared by all worker processes
+			file = open_url(request)
+			data = json.load(file)
+			file.close()
+		count += 1
+
+	return data
+
+
+
+# Load addresses, parents ("recurse up") and optionally children ("recurse down") in one combined Overpass query.
+# The query must contain the address union statement followed by "out center meta".
+# Result sets are separated by "make" elements in the response. Retry up to 5 times if no addresses (load could be empty).
+
+def load_overpass_combined (query, children):
+
+	combined_query = query.replace("(area.a););", "(area.a);)->.addr;")
+	combined_query = combined_query.replace("out center meta;",
+						".addr out center meta;make parents;out;.addr <;out meta;"
+						+ ("make children;out;.addr >;out meta;" if children else ""))
+
+	count = 0
+	osm_data = { 'elements': [] }
+	while not osm_data['elements'] and count < 5:
+		data = load_overpass(combined_query)
+		result = { 'addresses': [], 'parents': [], 'children': [] }
+		result_set = "addresses"
+		for element in data['elements']:
+			if element['type'] in result:  # Separator
+				result_set = element['type']
+			else:
+				result[ result_set ].append(element)
+
+		osm_data = data
+		osm_data['elements'] = result['addresses']
+		count += 1
+
+	return osm_data, { 'elements': result['parents'] }, { 'elements': result['children'] }
+
+
+
+# Load addresses, parents and optionally children from local snapshot of municipality in cache folder, patched with changes.
+# Only elements changed since the timestamp of the snapshot are loaded from Overpass ("newer"), together with ids of all
+# current elements to discover deleted elements. The full combined query is used if there is no usable snapshot.
+# Returns the same result as load_overpass_combined(), and saves the new snapshot.
+
+def load_overpass_snapshot (query, municipality_id, children):
+
+	snapshot_filename = os.path.join(cache_folder, "osm_%s.json" % municipality_id)
+	result = None
+
+	if os.path.isfile(snapshot_filename):
+		file = open(snapshot_filename, encoding="utf-8")
+		snapshot = json.load(file)
+		file.close()
+
+		if not children or snapshot['children'] is not None:
+			diff_query = query.replace("(area.a););", "(area.a);)->.addr;")
+			diff_query = diff_query.replace("out center meta;",
+							('.addr out ids;make addresses;out;nwr.addr(newer:"{0}")->.changed;.changed out center meta;'
+							+ 'make parent_ids;out;.addr < ->.up;.up out ids;make parents;out;(.changed <;nwr.up(newer:"{0}"););out meta;'
+							+ ('make child_ids;out;.addr > ->.down;.down out ids;make children;out;(.changed >;nwr.down(newer:"{0}"););out meta;'
+								if children else "")).format(snapshot['osm_base']))
+
+			data = load_overpass(diff_query)
+			result = { 'address_ids': [], 'addresses': [], 'parent_ids': [], 'parents': [], 'child_ids': [], 'children': [] }
+			result_set = "address_ids"
+			for element in data['elements']:
+				if element['type'] in result:  # Separator
+					result_set = element['type']
+				else:
+					result[ result_set ].append(element)
+
+			# Patch snapshot. Use full query if elements have been added without being changed (e.g. new municipality boundary).
+
+			for result_set, id_set in [("addresses", "address_ids"), ("parents", "parent_ids"), ("children", "child_ids")]:
+				if result_set == "children" and not children:
+					result['children'] = None  # Not loaded, and not patched with changes
+					continue
+
+				ids = set((element['type'], element['id']) for element in result[ id_set ])
+				elements = { (element['type'], element['id']): element for element in snapshot[ result_set ] if (element['type'], element['id']) in ids }
+				for element in result[ result_set ]:
+					if (element['type'], element['id']) in ids:
+						elements[ (element['type'], element['id']) ] = element
+
+				if len(elements) < len(ids) or not ids and result_set == "addresses":
+					result = None
+					break
+
+				type_order = { "node": 0, "way": 1, "relation": 2 }  # Same order as Overpass output
+				result[ result_set ] = sorted(elements.values(), key=lambda element: (type_order[ element['type'] ], element['id']))
+
+	if result is None:
+		osm_data, osm_parents, osm_children = load_overpass_combined(query, children)
+		data = osm_data
+		result = {
+			'addresses': osm_data['elements'],
+			'parents': osm_parents['elements'],
+			'children': osm_children['elements'] if children else None
+		}
+	else:
+		osm_data = { 'osm3s': data['osm3s'], 'elements': result['addresses'] }
+		osm_parents = { 'elements': result['parents'] }
+		osm_children = { 'elements': result['children'] if children else [] }
+
+	# Save snapshot before elements are modified during matching
+
+	snapshot = {
+		'osm_base': data['osm3s']['timestamp_osm_base'],
+		'addresses': result['addresses'],
+		'parents': result['parents'],
+		'children': result['children']
+	}
+
+	os.makedirs(cache_folder, exist_ok=True)
+	temp_filename = "%s.%i.tmp" % (snapshot_filename, os.getpid())
+	file = open(temp_filename, "w", encoding="utf-8")
+	json.dump(snapshot, file, ensure_ascii=False)
+	file.close()
+	os.replace(temp_filename, snapshot_filename)
+
+	return osm_data, osm_parents, osm_children
+
+
+
+# Return municipality id for administrative boundary tags, or None.
+# Same boundaries as used in Overpass queries.
+
+def boundary_municipality (tags):
+
+	if tags.get("admin_level") == "7" and tags.get("place") == "municipality" and "ref" in tags:
+		return tags['ref']
+	elif tags.get("admin_level") == "4" and tags.get("name") == "Svalbard":
+		return "2100"
+	else:
+		return None
+
+
+
+# Load OSM addresses, parents and optionally children for the entire country in one combined Overpass query,
+# and partition them into municipalities using municipality boundaries from Overpass.
+# Returns the same partitions as load_pbf(), avoiding one area query per municipality.
+
+def load_overpass_country (children):
+
+	if importlib.util.find_spec("shapely") is None:  # Only needed for partitioning
+		sys.exit ("Please install shapely to load OSM addresses for the entire country")
+
+	message ("Loading municipality boundaries from OSM Overpass... ")
+
+	area = '(area["ISO3166-1"="NO"][admin_level=2];area[name=Svalbard][admin_level=4];)->.a;'
+	query = (	'[out:json][timeout:900];' + area +
+				'(rel[boundary=administrative][admin_level=7][place=municipality][ref](area.a);'
+				'rel[boundary=administrative][admin_level=4][name=Svalbard];);'
+				'out geom;' )
+
+	boundaries = {}
+	for element in load_overpass(query, retry_empty=True)['elements']:
+		municipality_id = boundary_municipality(element['tags'])
+		if municipality_id in municipality:
+			boundaries[ municipality_id ] = boundary_polygon(element)
+
+	message ("%i\n" % len(boundaries))
+	message ("Loading existing addresses for entire country from OSM Overpass... ")
+
+	query = (	'[out:json][timeout:1800][maxsize:4000000000];' + area +
+				'(nwr[~"addr:"~".*"](area.a););'
+				'out center meta;' )
+
+	osm_data, osm_parents, osm_children = load_overpass_combined(query, children)
+
+	message ("%i addresses, %i parents\n" % (len(osm_data['elements']), len(osm_parents['elements'])))
+
+	data = {
+		'osm_base': osm_data.get('osm3s', {}).get('timestamp_osm_base'),
+		'addresses': [ element for element in osm_data['elements'] if element['type'] == "node" or "center" in element ],
+		'parents': osm_parents['elements'],
+		'children': osm_children['elements'] if children else None
+	}
+
+	return partition_osm_data(data, boundaries)
+
+
+
 # Output message
 
 def message (output_text):
@@ -110,7 +493,7 @@ def log (*args, **kwargs):
 		file_log = open(filename, "w")
 		output_text = "County;County name;Municipality;Municipality name;"\
 						+ "OSM addresses;OSM parents;OSM children;Kartverket addresses;Kartverket street names;"\
-						+ "Full match;Not full match;Corrected street names;New;Updated;Deleted;Remaining;Uploaded;Time\n"
+						+ "Full match;Not full match;Corrected street names;New;Updated;Deleted;Remaining;Uploaded;Conflicts;Time\n"
 		file_log.write (output_text)
 
 	elif "action" in kwargs and kwargs['action'] == "close":
@@ -126,14 +509,14 @@ def log (*args, **kwargs):
 
 
 
-# Search for and return osm child/member object in "recurse down" list from Overpass
+# Return osm child/member object in "recurse down" list from Overpass
 
-def find_element (id_no):
+def find_element (element_type, id_no):
 
-	for element in osm_children['elements']:
-		if element['id'] == id_no:
-			return element
-	return None
+	if (element_type, id_no) in osm_children_index:
+		return osm_children_index[ (element_type, id_no) ]
+	else:
+		return None
 
 
 
@@ -166,9 +549,25 @@ def fix_street_name (name):
 		used_corrections.add(name)
 		return corrections[ name ]
 
+	new_name = auto_fix_street_name(name)
+
+	if name != new_name:
+		all_used_corrections[ name ] = new_name
+		return new_name
+	else:
+		return name
+
+
+
+# Automatic corrections for dots and spacing + correction table for last part of name.
+# Results are cached, since the same street names are repeated for many addresses.
+
+@functools.lru_cache(maxsize=20000)
+def auto_fix_street_name (name):
+
 	# Loop characters in street name and make automatic corrections for dots and spacing
 
-	new_name = ""
+	new_name = []
 	length = len(name)
 
 	i = 0
@@ -178,48 +577,49 @@ def fix_street_name (name):
 
 		if name[i] == ".":
 			if name[i + 1] == " " and name[i + 3] in [".", " "]:  # Example "C. A. Pihls gate"
-				new_name = new_name + "." + name[i + 2]
+				new_name.append("." + name[i + 2])
 				i += 2
 				word = 1
 			elif name[i + 1] != " " and name[i + 2] not in [".", " "]:  # Example "Dr.Gregertsens vei"
-				new_name = new_name + ". "
+				new_name.append(". ")
 				word = 0
 			else:
-				new_name = new_name + "."
+				new_name.append(".")
 				word = 0
 
 		elif name[i] == " ":
 			# Avoid "Elvemo / Bávttevuolbállggis", "Skjomenveien - Elvegård", "Bakken i Lysefjorden", "Kristian 4 gate"
 			if word == 1 and name[i-1] not in ["-", "/", "i"] and not name[i-1].isdigit():
 				if name[i + 2] in [" ", "."]:  # Example "O G Hauges veg"
-					new_name = new_name + "."
+					new_name.append(".")
 				else:
-					new_name = new_name + ". "  # Example "K Sundts vei"
+					new_name.append(". ")  # Example "K Sundts vei"
 			else:
-				new_name = new_name + " "
+				new_name.append(" ")
 			word = 0
 
 		else:
-			new_name = new_name + name[i]
+			new_name.append(name[i])
 			word += 1
 
 		i += 1
 
-	new_name = new_name + name[i:i + 3]
+	new_name.append(name[i:i + 3])
+	new_name = "".join(new_name)
 
 	# Check correction table for last part of name
 
 	split_name = new_name.split()
+	lower_case = False
 	for i in range(1, len(split_name)):
 		if split_name[i] in ending_corrections:
 			split_name[i] = split_name[i].lower()
-			new_name = " ".join(split_name)
+			lower_case = True
 
-	if name != new_name:
-		all_used_corrections[ name ] = new_name
-		return new_name
-	else:
-		return name
+	if lower_case:
+		new_name = " ".join(split_name)
+
+	return new_name
 
 
 
@@ -244,14 +644,14 @@ def generate_element (element, action):
 		if "nodes" in element:
 			for node_ref in element['nodes']:
 				osm_element.append(ET.Element("nd", ref=str(node_ref)))
-				generate_element(find_element(node_ref), action="output")
+				generate_element(find_element("node", node_ref), action="output")
 
 	elif element['type'] == "relation":
 		osm_element = ET.Element("relation")
 		if "members" in element:
 			for member in element['members']:
 				osm_element.append(ET.Element("member", type=member['type'], ref=str(member['ref']), role=member['role']))
-				generate_element(find_element(member['ref']), action="output")
+				generate_element(find_element(member['type'], member['ref']), action="output")
 
 	if "tags" in element:
 		for key, value in iter(element['tags'].items()):
@@ -272,24 +672,147 @@ def generate_element (element, action):
 	if action == "delete":
 		osm_element.append(ET.Element("tag", k="DELETE", v="yes"))  # Display in JOSM
 
-	osm_root.append(osm_element)
-
 	if action != "output":
 		uploaded += 1
 		osm_element.set('action', "modify")  # Override action for XML file
+
+	write_osm_element(osm_file, osm_element)
+
+	if action != "output":
 		if upload:
 
-			# Do not upload if object has already been modified in this upload session (objects across municipality border)
-			if action == "modify":
-				for upload_element in upload_root:
-					if upload_element[0].attrib['id'] == osm_element.attrib['id']:
-						return
+			# Do not upload if object has already been modified or deleted in this upload session (objects across municipality border)
+			if action != "create" and not check_upload(element['type'], element['id'], action):
+				return
 
 			action_element = ET.Element(action)  # Add extra level for action
 			action_element.append(osm_element)
 			upload_root.append(action_element)
-			if action in ["create", "delete"] and save_new_deleted:
-				save_root.append(osm_element)
+
+
+
+# Register action for existing element in upload session.
+# Returns False if element has already been queued for upload, and counts conflicting actions.
+
+def check_upload (element_type, element_id, action):
+
+	global conflicts  # Number of elements not uploaded because of conflicting action earlier in upload session
+
+	upload_id = (element_type, element_id)
+	if upload_id in upload_ids:
+		if upload_ids[ upload_id ] != action:
+			message ("\n\t*** Conflict: %s %i already queued for %s, skipping %s\n" % (element_type, element_id, upload_ids[ upload_id ], action))
+			conflicts += 1
+		return False
+
+	upload_ids[ upload_id ] = action
+	return True
+
+
+
+# Store OSM elements in compact columns, in the same order.
+# Coordinates of nodes and centers of ways and relations are stored in typed arrays, and tag keys and values are interned.
+# Flags are bits in a bytearray. Nodes and members of ways and relations are kept per position.
+
+clean_flag = 1		# Only address tags
+pure_flag = 2		# Complete address and no other tags
+found_flag = 4		# Matched, no further action
+
+def compact_elements (elements):
+
+	table = {
+		'type': [],
+		'id': array('q'),
+		'lat': array('d'),
+		'lon': array('d'),
+		'version': array('l'),
+		'changeset': array('q'),
+		'uid': array('q'),
+		'user': [],
+		'timestamp': [],
+		'tags': [],
+		'refs': {},
+		'flags': bytearray(len(elements))
+	}
+
+	no_center = { 'lat': math.nan, 'lon': math.nan }
+
+	for i, element in enumerate(elements):
+		point = element if element['type'] == "node" else element.get('center', no_center)
+
+		table['type'].append(sys.intern(element['type']))
+		table['id'].append(element['id'])
+		table['lat'].append(point['lat'])
+		table['lon'].append(point['lon'])
+		table['version'].append(element['version'])
+		table['changeset'].append(element['changeset'])
+		table['uid'].append(element['uid'])
+		table['user'].append(sys.intern(element['user']))
+		table['timestamp'].append(element['timestamp'])
+		table['tags'].append({ sys.intern(key): sys.intern(value) for key, value in element.get('tags', {}).items() })
+
+		if "nodes" in element:
+			table['refs'][ i ] = element['nodes']
+		elif "members" in element:
+			table['refs'][ i ] = element['members']
+
+	return table
+
+
+
+# Return OSM element at position in compact columns, in the same format as returned by Overpass API.
+# Tags are copied and may be modified.
+
+def element_at (table, i):
+
+	element = {
+		'type': table['type'][ i ],
+		'id': table['id'][ i ],
+		'version': table['version'][ i ],
+		'changeset': table['changeset'][ i ],
+		'uid': table['uid'][ i ],
+		'user': table['user'][ i ],
+		'timestamp': table['timestamp'][ i ],
+		'tags': dict(table['tags'][ i ])
+	}
+
+	if element['type'] == "node":
+		element['lat'] = table['lat'][ i ]
+		element['lon'] = table['lon'][ i ]
+	elif element['type'] == "way":
+		element['nodes'] = table['refs'].get(i, [])
+	else:
+		element['members'] = table['refs'].get(i, [])
+
+	return element
+
+
+
+# Wait for background uploads which include any of the loaded OSM elements, unless the loaded OSM data already includes them.
+# Modifying elements from outdated versions would otherwise cause a conflict (HTTP 409) during upload.
+# Returns True if the OSM data must be loaded again.
+# Parameters:
+# - element_ids: Set of (type, id) of loaded OSM elements, compared with ids of upload, or with any ids after resumed upload
+# - osm_base: Overpass timestamp of loaded OSM data
+
+def wait_for_uploads(element_ids, osm_base):
+
+	overlap = [ history for history in upload_history
+				if (history['finished'] is None or osm_base is None or history['finished'] > osm_base)
+					and (history['ids'] is None or not history['ids'].isdisjoint(element_ids)) ]
+
+	if not overlap:
+		return False
+
+	if all(history['finished'] is not None for history in overlap):
+		message ("waiting for Overpass to include uploaded changes... ")
+		time.sleep(upload_wait)
+	else:
+		message ("waiting for background upload of the same elements... ")
+		for history in overlap:
+			history['done'].wait()
+
+	return True
 
 
 
@@ -297,10 +820,13 @@ def generate_element (element, action):
 
 def load_osm_addresses (municipality_id):
 
-	global osm_data			# Address elements downloaded from OSM, sorted by addr:street
+	global osm_elements		# Address elements downloaded from OSM in compact columns, sorted by addr:street
 	global osm_children		# Children elements downloaded from OSM
-	global parents 			# Set of id for parents of osm_data
-	global street_index 	# Dict with indexes into osm_data per street
+	global parents 			# Set of id for parents of osm_elements
+	global osm_children_index	# Dict with (type, id) index into osm_children
+	global osm_addr_index 	# Dict with list of positions of "pure" elements in osm_elements per full address
+	global osm_state 		# Overpass timestamp and number of addresses and parents, for incremental mode
+	global osm_base 		# Overpass timestamp of loaded OSM data
 
 	# Load Norwegian municipality name for given municipality number from parameter
 
@@ -308,7 +834,7 @@ def load_osm_addresses (municipality_id):
 
 	# Load existing addr nodes in OSM for municipality
 
-	message ("Loading existing addresses for %s from OSM Overpass... " % municipality[ municipality_id ])
+	message ("Loading existing addresses for %s from %s... " % (municipality[ municipality_id ], "OSM extract" if osm_partitions else "OSM Overpass"))
 
 	query = (	'[out:json][timeout:90];'
 				'(area[ref=%s][admin_level=7][place=municipality];)->.a;'
@@ -318,66 +844,76 @@ def load_osm_addresses (municipality_id):
 	if municipality_id == "2100":
 		query = query.replace("[ref=2100][admin_level=7][place=municipality]", "[name=Svalbard][admin_level=4]")
 
-	count = 0
-	osm_data = { 'elements': [] }
-	while not osm_data['elements'] and count < 5:  # Load could be empty from Overpass
-		request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
-		file = open_url(request)
-		osm_data = json.load(file)
-		file.close()
-		count += 1
-
-	street_index = dict()
+	# Load addresses, parents ("recurse up") and children ("recurse down") concurrently, or in one combined query
 
-	if osm_data['elements']:
+	queries = [ query, query.replace("out center meta", "<;out meta") ]
+	if not upload or debug:
+		queries.append(query.replace("out center meta", ">;out meta"))
 
-		# Sort list and make index to speed up matching
+	# Load again from Overpass after waiting if any of the addresses are being uploaded in the background
 
-		osm_data['elements'].sort(key=addr_sort)
-		if "addr:street" in osm_data['elements'][0]['tags']:
-			last_street = osm_data['elements'][0]['tags']['addr:street']
-			street_index[last_street] = {'from': 0, 'to': 0}
+	tries = 0
+	while True:
+		futures = None
+		if osm_partitions and tries == 0:
+			osm_data, osm_parents, osm_children = get_partition(osm_partitions, municipality_id, children=(not upload or debug))
+		elif osm_snapshot:
+			osm_data, osm_parents, osm_children = load_overpass_snapshot(query, municipality_id, children=(not upload or debug))
+		elif overpass_combined:
+			osm_data, osm_parents, osm_children = load_overpass_combined(query, children=(not upload or debug))
 		else:
-			last_street = None
+			executor = ThreadPoolExecutor(max_workers=overpass_slots)
+			futures = [ executor.submit(load_overpass, queries[0], retry_empty=True) ]
+			futures.extend([ executor.submit(load_overpass, parent_child_query) for parent_child_query in queries[1:] ])
+			executor.shutdown(wait=False)
+			osm_data = futures[0].result()
+
+		osm_base = osm_data.get('osm3s', {}).get('timestamp_osm_base')
+		if not wait_for_uploads(set((element['type'], element['id']) for element in osm_data['elements']), osm_base):
+			break
+
+		tries += 1
+		if tries > max_upload_waits:
+			message ("\n")
+			sys.exit("*** Uploaded changes are still not available from Overpass, please run again later\n")
 
-		i = -1
-		for element in osm_data['elements']:
-			i += 1
+	osm_addr_index = dict()
 
-			if "addr:street" in element['tags']:
-				this_street = element['tags']['addr:street']
-				if this_street != last_street:
-					street_index[last_street]['to'] = i - 1
-					street_index[this_street] = {'from': i, 'to': 0}
-					last_street = this_street
+	osm_data['elements'].sort(key=addr_sort)
+	osm_elements = compact_elements(osm_data['elements'])
+	flags = osm_elements['flags']
 
-		if last_street:
-			street_index[last_street]['to'] = i
+	# Set "clean" flag if only "addr:" tags, and no other tags
+	# Set "pure" flag if all of addr:street, addr:housenumber, addr:postcode, addr:city + optionaly addr:country are present, and no other tags
 
-		# Set "clean" flag if only "addr:" tags, and no other tags
-		# Set "pure" flag if all of addr:street, addr:housenumber, addr:postcode, addr:city + optionaly addr:country are present, and no other tags
+	for i, tags in enumerate(osm_elements['tags']):
 
-		for element in osm_data['elements']:
+		if osm_elements['type'][ i ] == "node":
+			addr_count = 0
+			clean = True
+			pure = True
 
-			if element['type'] == "node":
-				addr_count = 0
-				clean = True
-				pure = True
+			for tag in tags:
+				if tag in ["addr:street", "addr:housenumber", "addr:postcode", "addr:city"]:
+					addr_count += 1
+				elif tag != "addr:country":
+					pure = False
+					if tag[0:5] != "addr:":
+						clean = False
 
-				for tag in element['tags']:
-					if tag in ["addr:street", "addr:housenumber", "addr:postcode", "addr:city"]:
-						addr_count += 1
-					elif tag != "addr:country":
-						pure = False
-						if tag[0:5] != "addr:":
-							clean = False
+			if clean:
+				flags[ i ] |= clean_flag
+				if pure and addr_count == 4:
+					flags[ i ] |= pure_flag
 
-				element['clean'] = clean
-				element['pure'] = (clean and pure and (addr_count == 4))
+	# Make index of "pure" address nodes to speed up matching
 
-			else:
-				element['clean'] = False
-				element['pure'] = False
+	for i, tags in enumerate(osm_elements['tags']):
+		if flags[ i ] & pure_flag:
+			index = (tags['addr:street'], tags['addr:housenumber'], tags['addr:postcode'], tags['addr:city'])
+			if index not in osm_addr_index:
+				osm_addr_index[ index ] = []
+			osm_addr_index[ index ].append(i)
 
 
 	message ("%i" % (len(osm_data['elements'])))
@@ -385,11 +921,8 @@ def load_osm_addresses (municipality_id):
 
 	# Recurse up to get any parents
 
-	query = query.replace("out center meta", "<;out meta")
-	request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
-	file = open_url(request)
-	osm_parents = json.load(file)
-	file.close()
+	if futures:
+		osm_parents = futures[1].result()
 
 	parents = set()  # Will contain the id for children elements
 
@@ -405,34 +938,157 @@ def load_osm_addresses (municipality_id):
 	message (" +%i parent objects" % (len(osm_parents['elements'])))
 	log (len(osm_parents['elements']))
 
+	osm_state = {
+		'osm_base': osm_data.get('osm3s', {}).get('timestamp_osm_base'),
+		'addresses': len(osm_data['elements']),
+		'parents': len(osm_parents['elements'])
+	}
+
 	# Recurse down to get any childen
 
 	if not upload or debug:
-		query = query.replace("<;out meta", ">;out meta")
-		request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
-		file = open_url(request)
-		osm_children = json.load(file)
-		file.close()
+		if futures:
+			osm_children = futures[2].result()
 		message (" +%i child objects" % (len(osm_children['elements'])))
 	else:
 		osm_children = { 'elements': [] }
 
+	# Generate index to children for faster access
+
+	osm_children_index = dict()
+	for element in osm_children['elements']:
+		osm_children_index[ (element['type'], element['id']) ] = element
+
 	log (len(osm_children['elements']))
 
 
 
-# Process one municipality
+# Load Kartverket addresses from CSV file into compact columns, in one pass.
+# Coordinates are stored in typed arrays and repeated strings are interned.
+# Street names are corrected once per address.
+
+def load_addresses (csv_file):
+
+	addresses = {
+		'rows': 0,				# Number of rows in CSV file
+		'corrected': 0,			# Number of corrected street names
+		'lat': array('d'),
+		'lon': array('d'),
+		'street': [],
+		'housenumber': [],
+		'postcode': [],
+		'city': []
+	}
+
+	cities = {}  # Cache for converted city names
+
+	for row in csv.DictReader(TextIOWrapper(csv_file, "utf-8"), delimiter=";"):
+
+		addresses['rows'] += 1
+
+		if row['adressenavn']:
+
+			street = row['adressenavn']
+			new_street = fix_street_name(street)
+			if new_street != street:
+				addresses['corrected'] += 1
+
+			if row['poststed'] not in cities:
+				cities[ row['poststed'] ] = sys.intern(row['poststed'].title().replace(" I "," i "))
+
+			addresses['lat'].append(float(row['Nord']))
+			addresses['lon'].append(float(row['Øst']))
+			addresses['street'].append(sys.intern(new_street))
+			addresses['housenumber'].append(sys.intern(row['nummer'] + row['bokstav']))
+			addresses['postcode'].append(sys.intern(row['postnummer']))
+			addresses['city'].append(cities[ row['poststed'] ])
+
+	return addresses
+
+
+
+# Return hash of Kartverket addresses after street name corrections, independent of order in source file
+
+def hash_addresses (addresses):
+
+	lines = sorted("%s;%s;%s;%s;%.7f;%.7f" % (addresses['street'][i], addresses['housenumber'][i], addresses['postcode'][i],
+												addresses['city'][i], addresses['lat'][i], addresses['lon'][i])
+					for i in range(len(addresses['street'])))
+
+	return hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+
+
+
+# Load state of municipality from last run, or None if not available
+
+def load_state (municipality_id):
+
+	filename = os.path.join(state_folder, "%s.json" % municipality_id)
+	if not os.path.isfile(filename):
+		return None
+
+	file = open(filename)
+	state = json.load(file)
+	file.close()
+	return state
+
+
+
+# Save state of municipality for incremental mode
+
+def save_state (municipality_id, state):
+
+	os.makedirs(state_folder, exist_ok=True)
+	filename = os.path.join(state_folder, "%s.json" % municipality_id)
+	temp_filename = "%s.%i.tmp" % (filename, os.getpid())
+	file = open(temp_filename, "w")
+	json.dump(state, file, indent=1)
+	file.close()
+	os.replace(temp_filename, filename)
+
+
+
+# Check if OSM addresses and their parents in municipality are unchanged since state was saved.
+# Elements changed or created since the saved Overpass timestamp are counted, and deleted elements are
+# discovered by comparing the number of addresses and parents.
+
+def osm_unchanged (municipality_id, state):
+
+	if osm_partitions:
+		partition = osm_partitions['municipalities'].get(municipality_id, { 'addresses': [], 'parents': [] })
+		return ([ len(partition['addresses']), len(partition['parents']) ] == [ state['addresses'], state['parents'] ]
+				and all(element['timestamp'] <= state['osm_base'] for element in partition['addresses'] + partition['parents']))
+
+	query = (	'[out:json][timeout:90];'
+				'(area[ref=%s][admin_level=7][place=municipality];)->.a;'
+				'(nwr[~"addr:"~".*"](area.a);)->.addr;'
+				'.addr out count;'
+				'.addr <;out count;'
+				'(.addr; .addr <;)->.all;'
+				'nwr.all(newer:"%s");out count;' ) % (municipality_id, state['osm_base'])
+
+	if municipality_id == "2100":
+		query = query.replace("[ref=2100][admin_level=7][place=municipality]", "[name=Svalbard][admin_level=4]")
+
+	data = load_overpass(query)
+	counts = [ int(element['tags']['total']) for element in data['elements'] if element['type'] == "count" ]
+
+	return counts == [ state['addresses'], state['parents'], 0 ]
+
+
+
+# Process one municipality.
+# In incremental mode, the municipality is skipped if neither Kartverket nor OSM addresses have changed
+# since the last run without changes, since the result would be the same.
 
 def process_municipality (municipality_id):
 
 	global osm_id 		# Last OSM id generated (negative numbers)
 	global uploaded 	# Number of elements to be uploaded
-
-	# Load addresses from OSM
+	global conflicts 	# Number of elements not uploaded due to conflicts
 
 	start_time = time.time()
 	message ("\n\n%s %s\n" % (municipality_id, municipality[ municipality_id ]))
-	load_osm_addresses(municipality_id)
 
 	# Load latest address file for municipality from Kartverket
 
@@ -442,10 +1098,33 @@ def process_municipality (municipality_id):
 
 	message ("\nLoading address file '%s' from Kartverket\n" % filename)
 
-	file_in = open_url("https://nedlasting.geonorge.no/geonorge/Basisdata/MatrikkelenAdresse/CSV/" + filename + ".zip")
-	zip_file = zipfile.ZipFile(BytesIO(file_in.read()))
+	zip_filename = load_cached_file("https://nedlasting.geonorge.no/geonorge/Basisdata/MatrikkelenAdresse/CSV/" + filename + ".zip",
+										filename + ".zip")
+	zip_file = zipfile.ZipFile(zip_filename)
 	csv_file = zip_file.open(filename + "/matrikkelenAdresse.csv")
-	addr_table1, addr_table2 = tee(csv.DictReader(TextIOWrapper(csv_file, "utf-8"), delimiter=";"), 2)
+	addresses = load_addresses(csv_file)
+	csv_file.close()
+	zip_file.close()
+
+	# Skip municipality if no changes since last run, and the last run did not generate any changes (incremental mode).
+	# Changes generated in the last run would otherwise be missing from the output, unless they were applied to OSM.
+
+	if incremental:
+		source_hash = hash_addresses(addresses)
+		state = load_state(municipality_id)
+		if state and state.get('uploaded', 0) == 0 and state['source_hash'] == source_hash and osm_unchanged(municipality_id, state):
+			message ("\nNo changes in Kartverket or OSM addresses since %s, skipping\n" % state['osm_base'])
+			uploaded = 0
+			conflicts = 0
+			log (municipality_id[0:2], county[municipality_id[0:2]], municipality_id, municipality[ municipality_id ])
+			log (state['addresses'], state['parents'], "", addresses['rows'], len(addresses['street']), "", "", addresses['corrected'])
+			log (0, 0, 0, "", 0, 0)
+			log (int(time.time() - start_time), action="endline")
+			return
+
+	# Load addresses from OSM
+
+	load_osm_addresses(municipality_id)
 
 	# Initiate loop
 
@@ -453,109 +1132,78 @@ def process_municipality (municipality_id):
 	added = 0
 	modified = 0
 	deleted = 0
-	validated = 0
-	corrected = 0
+	validated = len(addresses['street'])
+	corrected = addresses['corrected']
 	uploaded = 0
+	conflicts = 0
 
-	found = []  # Index list which Will contain True for matched adresses from Kartverket 
+	found = bytearray(validated)  # Will contain 1 for matched adresses from Kartverket
 
 	message ("\nChecking addresses...")
 
 	# 1st pass:
 	# Find all 100% matches betweem Kartverket and OSM
 
-	checked = -1
-
-	for row in addr_table1:
-
-		checked += 1
-		found.append(False)
+	for checked in range(validated):
 
 		if (checked + 1) % 1000 == 0:
 				message ("\rChecking addresses... %i" % (checked + 1))
 
-		if row['adressenavn']:
-
-			validated += 1
-
-			latitude = float(row['Nord'])
-			longitude = float(row['Øst'])
-
-			street = row['adressenavn']
-			housenumber = row['nummer'] + row['bokstav']
-			postcode = row['postnummer']
-			city = row['poststed'].title().replace(" I "," i ")
-
-			new_street = fix_street_name(street)
-			if new_street != street:
-				street = new_street
-				corrected += 1
-
-			if street not in street_index:
-				continue
+		latitude = addresses['lat'][ checked ]
+		longitude = addresses['lon'][ checked ]
 
-			found_index = street_index[street]['from'] - 1
+		# Find first exact match of "pure" address node from OSM
 
-			# Loop existing addr objects from OSM to find first exact match of "pure" address node
+		index = (addresses['street'][ checked ], addresses['housenumber'][ checked ], addresses['postcode'][ checked ], addresses['city'][ checked ])
+		if index not in osm_addr_index:
+			continue
 
-			for osm_object in osm_data['elements'][ street_index[street]['from'] : street_index[street]['to'] + 1 ]:
-				found_index += 1
-				tags = osm_object['tags']
+		i = osm_addr_index[ index ].pop(0)
+		if not osm_addr_index[ index ]:
+			del osm_addr_index[ index ]
 
-				if (osm_object['pure']
-						and housenumber == tags['addr:housenumber']
-						and street == tags['addr:street']
-						and postcode == tags['addr:postcode']
-						and city == tags['addr:city']):
+		osm_elements['flags'][ i ] |= found_flag  # Mark match for no further action
+		tags = osm_elements['tags'][ i ]
 
-					found[ checked ] = True
-					matched += 1
+		found[ checked ] = 1
+		matched += 1
 
-					distance = compute_distance((longitude, latitude), (osm_object['lon'], osm_object['lat']))
+		distance = compute_distance((longitude, latitude), (osm_elements['lon'][ i ], osm_elements['lat'][ i ]))
 
-					# Modify object coordinates if it has been relocated more than 1 meter.
-					# Keep the existing node if it has parents.
+		# Modify object coordinates if it has been relocated more than 1 meter.
+		# Keep the existing node if it has parents.
 
-					if distance > 1.0 or 'addr:country' in tags:
+		if distance > 1.0 or 'addr:country' in tags:
 
-						if osm_object['id'] in parents:
-							modify_object = copy.deepcopy(osm_object)
-							modify_object['tags'] = {}
-							generate_element (modify_object, action="modify")  # Keep empty node if parents
-							modified += 1
+			if osm_elements['id'][ i ] in parents:
+				modify_object = element_at(osm_elements, i)
+				modify_object['tags'] = {}
+				generate_element (modify_object, action="modify")  # Keep empty node if parents
+				modified += 1
 
-							osm_object['lat'] = latitude
-							osm_object['lon'] = longitude
-							osm_object['tags'].pop('addr:country', None)
-							generate_element (osm_object, action="create")  # Create new addr node
-							added += 1
+				osm_elements['lat'][ i ] = latitude
+				osm_elements['lon'][ i ] = longitude
+				tags.pop('addr:country', None)
+				generate_element (element_at(osm_elements, i), action="create")  # Create new addr node
+				added += 1
 
-						else:
-							osm_object['lat'] = latitude
-							osm_object['lon'] = longitude
-							osm_object['tags'].pop('addr:country', None)
-							generate_element (osm_object, action="modify")
-							modified += 1
-
-					for index in iter(street_index.values()):
-						if index['from'] > found_index:
-							index['from'] -= 1
-						if index['to'] >= found_index:
-							index['to'] -= 1
-
-					del osm_data['elements'][ found_index ]  # Remove match to speed up looping later
-					break
+			else:
+				osm_elements['lat'][ i ] = latitude
+				osm_elements['lon'][ i ] = longitude
+				tags.pop('addr:country', None)
+				generate_element (element_at(osm_elements, i), action="modify")
+				modified += 1
 
 	# Report
 
-	message ("\rChecking addresses... %i\n" % (checked + 1))
+	message ("\rChecking addresses... %i\n" % addresses['rows'])
 	message ("\tAddresses in cadastral source:            %i\n" % validated)
 	if debug:
 		message ("\tAddresses with match:                     %i\n" % matched)
 		message ("\tAddresses without match:                  %i\n" % (validated - matched))
 		message ("\tAddresses with corrected street names:    %i\n\n" % corrected)
 
-	log (checked + 1, validated, matched, validated - matched, corrected)
+	log (addresses['rows'], validated, matched, validated - matched, corrected)
 
 	# 2nd pass:
 	# Find all remaining "pure" address nodes at same location which will be updated with new address information
@@ -564,128 +1212,120 @@ def process_municipality (municipality_id):
 
 #	message ("\nCompleting update ... ")
 
-	checked2 = -1
-	for row in addr_table2:
-		checked2 += 1
-
-		if row['adressenavn']:
-
-			if not found[ checked2 ]:
+	flags = osm_elements['flags']
+	positions = [ i for i in range(len(flags)) if flags[ i ] & clean_flag and not flags[ i ] & found_flag ]
+	grid = build_grid(osm_elements, positions, 10)  # Spatial index of remaining "clean" nodes, 10 meters cells
 
-				latitude = float(row['Nord'])
-				longitude = float(row['Øst'])
+	for checked in range(validated):
 
-				street = row['adressenavn']
-				housenumber = row['nummer'] + row['bokstav']
-				postcode = row['postnummer']
-				city = row['poststed'].title().replace(" I "," i ")
+		if found[ checked ]:
+			continue
 
-				street = fix_street_name(street) 
+		latitude = addresses['lat'][ checked ]
+		longitude = addresses['lon'][ checked ]
 
-				# Loop existing addr objects to find best close match with "pure" address node, to be modified
-				# Consider the match close if distance is less than 10 meters
+		street = addresses['street'][ checked ]
+		housenumber = addresses['housenumber'][ checked ]
+		postcode = addresses['postcode'][ checked ]
+		city = addresses['city'][ checked ]
 
-				best_distance = 10  # Minimum meters
-				modify = False
+		# Loop existing addr objects to find best close match with "pure" address node, to be modified
+		# Consider the match close if distance is less than 10 meters (grid cell size)
 
-				for i, osm_object in enumerate(osm_data['elements']):
-					if osm_object['clean']:
+		found_index = grid_nearest(grid, (longitude, latitude))
+		modify = (found_index is not None)
 
-						distance = compute_distance((longitude, latitude), (osm_object['lon'], osm_object['lat']))
+		# Output new addr node to file if no match, or modified addr node if close location match
 
-						if distance < best_distance:
-							keep_object = osm_object
-							found_index = i
-							best_distance = distance
-							modify = True
-
-				# Output new addr node to file if no match, or modified addr node if close location match
- 
-				if modify:
-					modify_object = copy.deepcopy(keep_object)
-					del osm_data['elements'][ found_index ]
-				else:
-					modify_object = {}
-					modify_object['type'] = "node"
-				
-				modify_object['tags'] = {
-					'addr:street': street,
-					'addr:housenumber': housenumber,
-					'addr:postcode': postcode,
-					'addr:city': city					
-				}
-
-				modify_object["lat"] = latitude
-				modify_object['lon'] = longitude
-
-				if modify:
+		if modify:
+			modify_object = element_at(osm_elements, found_index)
+			grid_remove(grid, osm_elements, found_index)
+			flags[ found_index ] |= found_flag
+		else:
+			modify_object = {}
+			modify_object['type'] = "node"
+		
+		modify_object['tags'] = {
+			'addr:street': street,
+			'addr:housenumber': housenumber,
+			'addr:postcode': postcode,
+			'addr:city': city					
+		}
+
+		modify_object["lat"] = latitude
+		modify_object['lon'] = longitude
+
+		if modify:
+
+			if modify_object['id'] in parents:
+				keep_object = element_at(osm_elements, found_index)
+				keep_object['tags'] = {}
+				generate_element (keep_object, action="modify")  # Keeo empty node if parents
+				modified += 1
 
-					if modify_object['id'] in parents:
-						keep_object['tags'] = {}
-						generate_element (keep_object, action="modify")  # Keeo empty node if parents
-						modified += 1
+				generate_element (modify_object, action="create")  # Create new addr node
+				added += 1
 
-						generate_element (modify_object, action="create")  # Create new addr node
-						added += 1
+			else:
+				generate_element (modify_object, action="modify")
+				modified += 1
 
-					else:
-						generate_element (modify_object, action="modify")
-						modified += 1
+		else:
+			generate_element (modify_object, action="create")
+			added += 1
 
-				else:
-					generate_element (modify_object, action="create")
-					added += 1
+	positions = [ i for i in range(len(flags)) if not flags[ i ] & found_flag ]
 
 	# 3rd pass:
 	# Output copy of remaining, non-matched addr objects to file (candidates for manual deletion of address tags and potentially also addr nodes)
 	# Delete remaining "clean" addr nodes (they got no match).
 	# Remove addr tags from ways and relations (addr tags will be on separate addr nodes)
 
-	for osm_object in osm_data['elements']:
+	for i in positions:
 
-		if osm_object['clean']:
+		tags = osm_elements['tags'][ i ]
+
+		if flags[ i ] & clean_flag:
 			# Delete "pure" address node
 
-			if osm_object['id'] in parents:
-				keep_object = copy.deepcopy(osm_object)
+			if osm_elements['id'][ i ] in parents:
+				keep_object = element_at(osm_elements, i)
 				keep_object['tags'] = {}
 				generate_element (keep_object, action="modify")  # Keep empty node if parents
 				modified += 1
 			else:
 				deleted += 1
-				generate_element (osm_object, action="delete")
+				generate_element (element_at(osm_elements, i), action="delete")
 
 		else:
 			# Delete "addr:" tags, except if "addr" is included in note=*
 			# Add any handling of buildings or features (amenity etc) in this section, if desired.
 
-			modify_object = copy.deepcopy(osm_object)
+			modify_object = element_at(osm_elements, i)
 			found_addr_tag = False
 			found_other_tag = False
 			found_note = False
 
-			for tag in osm_object['tags']:
+			for tag in tags:
 				if tag[0:5] == "addr:":
 					modify_object['tags'].pop(tag)
 					found_addr_tag = True
 #				elif (tag in ["amenity", "leisure", "tourism", "shop", "office", "craft", "club"]):  # (earlier strategy, replaced by note)
-				elif tag == "note" and "addr" in osm_object['tags'][tag]:  # Opt-out note found
+				elif tag == "note" and "addr" in tags[tag]:  # Opt-out note found
 					found_note = True
 				elif "image" not in tag and "note" not in tag and "mapillary" not in tag:
 					found_other_tag = True
 
 			if found_addr_tag and not found_note:
-				if found_other_tag or osm_object['id'] in parents:
+				if found_other_tag or osm_elements['id'][ i ] in parents:
 #					modify_object['lat'] += 0.00005  # Offset approx 5 meters from addr node
 					generate_element (modify_object, action="modify")
 					modified += 1
 				else:
-					generate_element (osm_object, action="delete")
+					generate_element (element_at(osm_elements, i), action="delete")
 					deleted += 1
 			else:
-				generate_element (osm_object, action="output")  # No proper addr tag or opt-out note found
-
-	file_in.close()
+				generate_element (element_at(osm_elements, i), action="output")  # No proper addr tag or opt-out note found
 
 	# Report
 
@@ -693,96 +1333,540 @@ def process_municipality (municipality_id):
 	message ("\tUpdated existing address nodes:           %i\n" % modified)
 	message ("\tDeleted existing address nodes:           %i\n" % deleted)
 	message ("\tTotal changeset elements:                 %i\n" % uploaded)
-	message ("\tRemaining addresses in OSM without match: %i\n" % (len(osm_data['elements']) - deleted))
+	if conflicts:
+		message ("\tConflicts with earlier changes:           %i\n" % conflicts)
+	message ("\tRemaining addresses in OSM without match: %i\n" % (len(positions) - deleted))
 
 	# Report time used
 
 	time_spent = time.time() - start_time
 	message ("\nTime %i seconds (%i addresses per second)\n" % (time_spent, validated / time_spent))
 
-	log (added, modified, deleted, len(osm_data['elements']) - deleted, uploaded)
+	log (added, modified, deleted, len(positions) - deleted, uploaded, conflicts)
 	log (int(time_spent), action="endline")
 
+	# Save state of Kartverket and OSM addresses (incremental mode).
+	# The number of changes is saved too, since only a run without changes may be skipped next time.
+
+	if incremental and osm_state['osm_base']:
+		osm_state['source_hash'] = source_hash
+		osm_state['uploaded'] = uploaded
+		save_state(municipality_id, osm_state)
+
+
+
+# Set up global data in worker process for concurrent processing of municipalities
+
+def init_worker (worker_data):
+
+	global municipality, county, corrections, ending_corrections, upload, offline, incremental, overpass_semaphore
+	global upload_history, inherited_log
+
+	municipality, county, corrections, ending_corrections, upload, offline, incremental, overpass_semaphore = worker_data
+	upload_history = []  # Background uploads are checked by merge_municipality() in main process
+	inherited_log = globals().get("file_log")  # Log file of main process must not be closed by worker when process_worker() replaces it
 
 
-# Create XML roots, to be output later
 
-def init_root():
+# Process one municipality in worker process.
+# Returns generated elements, counters, log row and screen output, to be merged by merge_municipality() in main process.
+# New elements get negative id from -1 and are renumbered when merged.
 
-	global osm_root		# XML of all addresses in municipality
+def process_worker (task):
+
+	global osm_id, osm_base, file_log, used_corrections, all_used_corrections, osm_partitions
+
+	municipality_id, osm_partitions = task  # Only the partition of the municipality is passed to the worker
+
+	osm_id = 0
+	osm_base = None
+	init_root(stream=False)
+	used_corrections = set()
+	all_used_corrections = {}
+	file_log = StringIO()
+
+	result = { 'municipality': municipality_id }
+	stdout = sys.stdout
+	sys.stdout = StringIO()
+
+	try:
+		process_municipality(municipality_id)
+	except SystemExit as e:  # Fatal error in open_url() etc
+		result['error'] = str(e.code) if e.code else ""
+	finally:
+		result['output'] = sys.stdout.getvalue()
+		sys.stdout = stdout
+
+	if "error" not in result:
+		result.update({
+			'osm_id': osm_id,
+			'uploaded': uploaded,
+			'osm_base': osm_base,
+			'log': file_log.getvalue(),
+			'osm_root': osm_file['elements'],
+			'upload_root': list(upload_root),
+			'used_corrections': used_corrections,
+			'all_used_corrections': all_used_corrections
+		})
+
+	return result
+
+
+
+# Merge result from process_worker() into XML roots of main process, in the same order as sequential processing.
+# New element ids are renumbered to continue from osm_id, and elements already in upload session are skipped.
+
+def merge_municipality (result):
+
+	global osm_id, uploaded, conflicts
+
+	message (result['output'])
+	if "error" in result:
+		pool.terminate()
+		sys.exit(result['error'])
+
+	# Process again in main process if elements were loaded before being uploaded in the background
+
+	element_ids = set((action_element[0].tag, int(action_element[0].get('id')))
+						for action_element in result['upload_root'] if action_element.tag != "create")
+	if wait_for_uploads(element_ids, result['osm_base']):
+		message ("processing again\n")
+		process_municipality(result['municipality'])
+		return
+
+	# Renumber new elements (same element may be shared between roots)
+
+	renumbered = set()
+	for element in result['osm_root'] + [ action_element[0] for action_element in result['upload_root'] ]:
+		if id(element) not in renumbered and int(element.get('id')) < 0:
+			element.set('id', str(osm_id + int(element.get('id'))))
+			renumbered.add(id(element))
+
+	osm_id += result['osm_id']
+
+	for element in result['osm_root']:
+		write_osm_element(osm_file, element)
+
+	conflicts = 0
+	for action_element in result['upload_root']:
+		element = action_element[0]
+		if action_element.tag == "create" or check_upload(element.tag, int(element.get('id')), action_element.tag):
+			upload_root.append(action_element)
+
+	# Add conflicts across municipality border to log row
+
+	log_row = result['log'].rstrip("\n").split(";")
+	log_row[-2] = str(int(log_row[-2]) + conflicts)
+	log (*log_row[:-1])
+	log (log_row[-1], action="endline")
+
+	used_corrections.update(result['used_corrections'])
+	all_used_corrections.update(result['all_used_corrections'])
+	uploaded = result['uploaded']
+
+
+
+# Create XML roots, to be output later.
+# OSM file is streamed to a temporary file which is kept or discarded by upload_changeset().
+# Parameter:
+# - stream: If False, elements are only collected in memory (worker processes)
+
+def init_root(stream=True):
+
+	global osm_file		# Streamed OSM file of all addresses in municipality/county
 	global upload_root	# XML to be uploaded to OSM
-	global save_root 	# XML of all deleted addresses during run
+	global upload_ids	# Dict with action per (type, id) of existing elements in upload_root
 
-	osm_root = ET.Element("osm", version="0.6", generator="addr2osm v%s" % version, upload="false")
+	if "osm_file" in globals():
+		close_osm_file(osm_file)  # Discard if not saved by upload_changeset()
+
+	if stream:
+		osm_file = open_osm_file("address_import.%i.tmp" % os.getpid())
+	else:
+		osm_file = open_osm_file()
 	upload_root = ET.Element("osmChange", version="0.6", generator="nsr2osm")
-	if "save_root" not in globals():
-		save_root = ET.Element("osm", version="0.6", generator="addr2osm v%s" % version, upload="false")
+	upload_ids = dict()
 
 
 
-# Upload changeset to OSM
+# Open OSM file for writing elements one by one as they are generated.
+# Output is identical to ElementTree.write() of a complete tree after indent_tree().
+# Without filename, elements are only collected in the 'elements' list.
 
-def upload_changeset(entity_id, entity_name, changeset_count):
+def open_osm_file (filename=None):
 
-	if upload and changeset_count > 0:
+	osm_file = {
+		'filename': filename,
+		'file': None,
+		'elements': [],
+		'count': 0,
+		'header': ET.tostring(ET.Element("osm", version="0.6", generator="addr2osm v%s" % version, upload="false"), encoding="unicode")
+	}
 
-		if changeset_count < 9900:  # Maximum upload is 10.000 elements
-			
-			today_date = time.strftime("%Y-%m-%d", time.localtime())
+	if filename:
+		osm_file['file'] = open(filename, "w", encoding="utf-8", errors="xmlcharrefreplace")
+		osm_file['file'].write("<?xml version='1.0' encoding='utf-8'?>\n")
 
-			changeset_root = ET.Element("osm")
-			changeset_element = ET.Element("changeset")
-			changeset_element.append(ET.Element("tag", k="comment", v="Address import update for %s" % entity_name))
-			changeset_element.append(ET.Element("tag", k="source", v="Kartverket: Matrikkelen Adresse"))
-			changeset_element.append(ET.Element("tag", k="source:date", v=today_date))
-			changeset_root.append(changeset_element)
-			changeset_xml = ET.tostring(changeset_root, encoding='utf-8', method='xml')
+	return osm_file
 
-			request = urllib.request.Request(osm_api + "changeset/create", data=changeset_xml, headers=osm_request_header, method="PUT")
-			file = open_url(request)  # Create changeset
-			changeset_id = file.read().decode()
-			file.close()	
 
-			message ("Uploading %i elements for %s to OSM in changeset #%s... " % (changeset_count, entity_name, changeset_id))
 
-			for element in upload_root:
-				element[0].set("changeset", changeset_id)  # Update changeset for element
+# Write one OSM element to OSM file, or collect it if no file.
 
-			indent_tree(upload_root)
-			changeset_xml = ET.tostring(upload_root, encoding='utf-8', method='xml')
+def write_osm_element (osm_file, osm_element):
 
-			request = urllib.request.Request(osm_api + "changeset/%s/upload" % changeset_id, data=changeset_xml, headers=osm_request_header)
-			file = open_url(request)  # Post changeset in one go
-			file.close()
+	if osm_file['file'] is None:
+		osm_file['elements'].append(osm_element)
+		return
 
-			request = urllib.request.Request(osm_api + "changeset/%s/close" % changeset_id, headers=osm_request_header, method="PUT")
-			file = open_url(request)  # Close changeset
-			file.close()
+	if not osm_file['count']:
+		osm_file['file'].write(osm_file['header'][:-3] + ">")  # Open root element
 
-			if debug:
-				file_out = open("addr_changeset.xml", "w")
-				file_out.write(changeset_xml.decode())
-				file_out.close()
+	indent_tree(osm_element, level=1)
+	osm_element.tail = None
+	osm_file['file'].write("\n  " + ET.tostring(osm_element, encoding="unicode"))
+	osm_file['count'] += 1
 
-			message ("Done\n")
-			return True
 
-		else:
-			message ("\n\nCHANGESET TOO LARGE (%i) - UPLOAD MANUALLY WITH JOSM\n\n" % changeset_count)
-			not_uploaded.append("%s %s" % (entity_id, entity_name))
 
-	if not upload and changeset_count > 0 or upload and changeset_count >= 9900 or debug:
-		osm_tree = ET.ElementTree(osm_root)
-		indent_tree(osm_root)
+# Close OSM file and save it with given filename, or discard it if no filename.
+
+def close_osm_file (osm_file, filename=None):
+
+	if osm_file['file'] is None or osm_file['file'].closed:
+		return
+
+	if osm_file['count']:
+		osm_file['file'].write("\n</osm>\n")
+	else:
+		osm_file['file'].write(osm_file['header'])
+	osm_file['file'].close()
+
+	if filename:
+		os.replace(osm_file['filename'], filename)
+	else:
+		os.remove(osm_file['filename'])
+
+
+
+# Discard streamed OSM files which were not saved when the program stops, including after errors and Ctrl-C.
+# Registered with atexit by the main program.
+
+def remove_temporary_files():
+
+	for name in ["osm_file", "save_file"]:
+		if name in globals():
+			close_osm_file(globals()[ name ])
+
+
+
+# Upload changeset to OSM.
+# Changes are split into several changesets of max_changeset_size elements, in dependency order (create, modify, delete).
+# Upload is done by upload_worker() in background, while the next county/municipality is processed.
+# Parts not yet uploaded are kept in resume file, to be uploaded by resume_upload() if the upload is interrupted.
+
+def upload_changeset(entity_id, entity_name, changeset_count):
+
+	global upload_thread
+
+	if upload and changeset_count > 0:
+
+		action_elements = list(upload_root)
+		if len(action_elements) > max_changeset_size:  # Keep original order if only one part
+			action_order = {"create": 0, "modify": 1, "delete": 2}
+			action_elements.sort(key=lambda action_element: action_order[ action_element.tag ])
+
+		parts = []
+		for i in range(0, len(action_elements), max_changeset_size):
+			part_root = ET.Element("osmChange", version="0.6", generator="nsr2osm")
+			part_root.extend(action_elements[ i : i + max_changeset_size ])
+			indent_tree(part_root)
+			parts.append(part_root)
+
+		job = {
+			'entity_id': entity_id,
+			'entity_name': entity_name,
+			'parts': len(parts),
+			'changeset': None,  # Open changeset of first part while it is being uploaded
+			'changes': [ ET.tostring(part_root, encoding='unicode', method='xml') for part_root in parts ]
+		}
+
+		with upload_lock:
+			pending_uploads.append(job)
+			save_resume()
+
+		history = {
+			'ids': set((action_element[0].tag, int(action_element[0].get('id')))
+						for action_element in upload_root if action_element.tag != "create"),
+			'finished': None,  # UTC time when upload ended
+			'done': threading.Event()
+		}
+		upload_history.append(history)
+
+		close_osm_file(osm_file)
+
+		if upload_thread is None:
+			upload_thread = threading.Thread(target=upload_worker)
+			upload_thread.start()
+		upload_queue.put((job, parts, upload_root, history))  # Waits if queue is full
+		return True
+
+	if not upload and changeset_count > 0 or debug:
 		out_filename = "address_import_%s_%s.osm" % (entity_id, entity_name)
 		out_filename = out_filename.replace(" ", "_")
-		osm_tree.write(out_filename, encoding="utf-8", method="xml", xml_declaration=True)
+		close_osm_file(osm_file, out_filename)
 		message ("Saved %i updates to file '%s'\n" % (changeset_count, out_filename))
+	else:
+		close_osm_file(osm_file)
 
 	return False
 
 
 
+# Upload first part of changes not yet uploaded for job to OSM in a new changeset.
+# The changeset id is kept in the resume file during upload, and the part is removed from the resume file right after upload.
+# Parameters:
+# - job: Dict with entity name, total number of parts and XML of parts not yet uploaded, as saved in resume file
+# - part_root: osmChange XML of first part not yet uploaded
+
+def upload_part(job, part_root):
+
+	entity_name = job['entity_name']
+	parts = job['parts']
+	part = parts - len(job['changes']) + 1
+
+	today_date = time.strftime("%Y-%m-%d", time.localtime())
+
+	comment = "Address import update for %s" % entity_name
+	if parts > 1:
+		comment += " (part %i of %i)" % (part, parts)
+
+	changeset_root = ET.Element("osm")
+	changeset_element = ET.Element("changeset")
+	changeset_element.append(ET.Element("tag", k="comment", v=comment))
+	changeset_element.append(ET.Element("tag", k="source", v="Kartverket: Matrikkelen Adresse"))
+	changeset_element.append(ET.Element("tag", k="source:date", v=today_date))
+	changeset_root.append(changeset_element)
+	changeset_xml = ET.tostring(changeset_root, encoding='utf-8', method='xml')
+
+	request = urllib.request.Request(osm_api + "changeset/create", data=changeset_xml, headers=osm_request_header, method="PUT")
+	file = open_url(request)  # Create changeset
+	changeset_id = file.read().decode()
+	file.close()	
+
+	with upload_lock:
+		job['changeset'] = changeset_id
+		save_resume()
+
+	if parts > 1:
+		message ("Uploading %i elements for %s (part %i of %i) to OSM in changeset #%s... " % (len(part_root), entity_name, part, parts, changeset_id))
+	else:
+		message ("Uploading %i elements for %s to OSM in changeset #%s... " % (len(part_root), entity_name, changeset_id))
+
+	for element in part_root:
+		element[0].set("changeset", changeset_id)  # Update changeset for element
+
+	indent_tree(part_root)
+	changeset_xml = ET.tostring(part_root, encoding='utf-8', method='xml')
+
+	request = urllib.request.Request(osm_api + "changeset/%s/upload" % changeset_id, data=changeset_xml, headers=osm_request_header)
+	file = open_url(request)  # Post changeset in one go
+	file.close()
+
+	with upload_lock:
+		remove_part(job)
+
+	close_changeset(changeset_id)
+
+	if debug:
+		file_out = open("addr_changeset.xml", "w")
+		file_out.write(changeset_xml.decode())
+		file_out.close()
+
+	message ("Done\n")
+
+
+
+# Close changeset in OSM.
+
+def close_changeset(changeset_id):
+
+	request = urllib.request.Request(osm_api + "changeset/%s/close" % changeset_id, headers=osm_request_header, method="PUT")
+	file = open_url(request)  # Close changeset
+	file.close()
+
+
+
+# Remove first part of job from resume file after it has been uploaded.
+# Must be called with upload_lock.
+
+def remove_part(job):
+
+	job['changes'].pop(0)
+	job['changeset'] = None
+	if not job['changes']:
+		pending_uploads.remove(job)
+	save_resume()
+
+
+
+# Upload remaining parts of one upload job.
+# Stops if the main program has ended or crashed, and returns False. Remaining parts are kept in resume file.
+# Parameters:
+# - job: Dict with entity name, total number of parts and XML of parts not yet uploaded, as saved in resume file
+# - parts: osmChange XML of parts not yet uploaded
+
+def upload_job(job, parts):
+
+	while parts:
+		if not threading.main_thread().is_alive():
+			return False
+		upload_part(job, parts.pop(0))
+
+	return True
+
+
+
+# Upload jobs from upload queue in background thread.
+# After a failed upload, remaining jobs are only kept in resume file.
+# Stops at end of queue, or when main program has ended or crashed (e.g. KeyboardInterrupt). Jobs not uploaded are kept in resume file.
+# The upload history of each job is marked as finished for wait_for_uploads().
+
+def upload_worker():
+
+	global upload_error
+
+	while threading.main_thread().is_alive():
+		try:
+			item = upload_queue.get(timeout=1)
+		except queue.Empty:
+			continue
+
+		if item is None:
+			break
+
+		job, parts, action_elements, history = item
+		try:
+			if upload_error is None:
+				try:
+					if upload_job(job, parts):
+						write_new_deleted(action_elements)
+				except SystemExit:  # Error message already given by open_url()
+					upload_error = job['entity_name']
+				except Exception as e:
+					message ("\n*** Upload error: %s\n" % str(e))
+					upload_error = job['entity_name']
+
+			if upload_error is not None:
+				not_uploaded.append("%s %s" % (job['entity_id'], job['entity_name']))
+
+		finally:
+			history['finished'] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+			history['done'].set()
+
+
+
+# Wait for background upload to finish, and report counties/municipalities not uploaded.
+
+def finish_uploads():
+
+	if upload_thread is not None:
+		upload_queue.put(None)
+		upload_thread.join()
+
+	if not_uploaded:
+		message ("\n*** Upload of %s failed. %i changesets not uploaded are saved in '%s' and will be uploaded when restarting with -upload\n"
+					% (upload_error, sum(len(job['changes']) for job in pending_uploads), resume_filename))
+		message ("Counties/municipalities not uploaded (use -discard to drop them instead):\n")
+		for line in not_uploaded:
+			message ("\t%s\n" % line)
+		message ("\n")
+
+
+
+# Save parts of changes not yet uploaded to resume file, or remove resume file when all parts have been uploaded.
+# Must be called with upload_lock.
+
+def save_resume():
+
+	if pending_uploads:
+		tmp_filename = resume_filename + ".%i.tmp" % os.getpid()
+		file = open(tmp_filename, "w", encoding="utf-8")
+		json.dump(pending_uploads, file, ensure_ascii=False)
+		file.close()
+		os.replace(tmp_filename, resume_filename)
+
+	elif os.path.isfile(resume_filename):
+		os.remove(resume_filename)
+
+
+
+# Check changeset of a part which was being uploaded when the upload was interrupted.
+# Diff uploads are atomic, so the part has been uploaded if the changeset contains changes. The changeset is closed if still open.
+
+def check_changeset(job):
+
+	changeset_id = job['changeset']
+	request = urllib.request.Request(osm_api + "changeset/%s" % changeset_id, headers=osm_request_header)
+	file = open_url(request)
+	changeset_element = ET.parse(file).getroot().find("changeset")
+	file.close()
+
+	if changeset_element.get("open") == "true":
+		close_changeset(changeset_id)
+
+	with upload_lock:
+		if int(changeset_element.get("changes_count", "0")) > 0:
+			message ("Part of %s was already uploaded in changeset #%s\n" % (job['entity_name'], changeset_id))
+			remove_part(job)
+		else:
+			job['changeset'] = None
+			save_resume()
+
+
+
+# Upload remaining parts from resume file after an interrupted upload.
+# Must be done before new changes are generated from OSM data.
+# OSM data is then loaded again until Overpass includes the resumed changes, by wait_for_uploads().
+
+def resume_upload():
+
+	file = open(resume_filename, encoding="utf-8")
+	pending_uploads.extend(json.load(file))
+	file.close()
+
+	resumed = False
+	for job in list(pending_uploads):
+		if job.get('changeset'):
+			check_changeset(job)
+			resumed = True
+		if job['changes']:
+			message ("Resuming interrupted upload of %i remaining part(s) for %s\n" % (len(job['changes']), job['entity_name']))
+			upload_job(job, [ ET.fromstring(changes) for changes in job['changes'] ])
+			resumed = True
+
+	# Ids of new elements are not known, so all OSM data must include the resumed changes before it is used
+
+	if resumed:
+		history = { 'ids': None, 'finished': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), 'done': threading.Event() }
+		history['done'].set()
+		upload_history.append(history)
+
+	message ("\n")
+
+
+
+# Write new and deleted elements of upload session to file with all new and deleted addresses during run
+
+def write_new_deleted(action_elements):
+
+	if save_new_deleted:
+		for action_element in action_elements:
+			if action_element.tag in ["create", "delete"]:
+				write_osm_element(save_file, action_element[0])
+
+
+
 # Insert line feeds into XLM file.
 
 def indent_tree(elem, level=0):
@@ -842,23 +1926,84 @@ if __name__ == '__main__':
 	total_start_time = time.time()
 	message ("\n-- addr2osm v%s --\n" % version)
 
-	if (len(sys.argv) in [2,3] and len(sys.argv[1]) in [2,4] and sys.argv[1].isdigit()
-			and (len(sys.argv) == 2 or sys.argv[2] == "-upload")):
-		entity = sys.argv[1]
-		upload = ("-upload" in sys.argv)
-	else:
+	entity = ""
+	upload = False
+	offline = False  # Use cached files only
+	incremental = False  # Skip municipalities without changes since last run
+	jobs = 1  # Number of municipalities processed concurrently
+	pbf_filename = None  # Local OSM extract instead of Overpass
+	country = False  # One Overpass query for the entire country instead of one per municipality
+	discard = False  # Discard changes not uploaded in resume file
+
+	args = sys.argv[1:]
+	if args and len(args[0]) in [2,4] and args[0].isdigit():
+		entity = args.pop(0)
+		while args:
+			arg = args.pop(0)
+			if arg == "-upload":
+				upload = True
+			elif arg == "-offline":
+				offline = True
+			elif arg == "-incremental":
+				incremental = True
+			elif arg == "-jobs" and args and args[0].isdigit() and int(args[0]) > 0:
+				jobs = int(args.pop(0))
+			elif arg == "-pbf" and args:
+				pbf_filename = args.pop(0)
+			elif arg == "-country":
+				country = True
+			elif arg == "-discard":
+				discard = True
+			else:
+				entity = ""
+				break
+
+	if not entity:
 		sys.exit (('Usage: Please type "python addr2osm.py <nnnn>" with 4 digit municipality number or 2 digit county number\n'
-					'       Add "-upload" to automatically upload changes to OSM\n'))
+					'       Add "-upload" to automatically upload changes to OSM\n'
+					'       Add "-jobs <n>" to process n municipalities concurrently in county or country runs\n'
+					'       Add "-offline" to use cached files only\n'
+					'       Add "-incremental" to skip municipalities without changes in Kartverket or OSM since last run\n'
+					'       Add "-pbf <file>" to load OSM addresses from local OSM extract instead of Overpass\n'
+					'       Add "-country" to load OSM addresses for the entire country in one Overpass query in country (00) runs\n'
+					'       Add "-discard" to discard changes from an interrupted upload instead of resuming it\n'))
+
+	if country and entity != "00":  # Overpass query would load the entire country anyway
+		sys.exit ("Please use '-country' only for the entire country (00)\n\n")
+
+	overpass_semaphore = multiprocessing.Semaphore(overpass_slots)  # Limits concurrent Overpass queries of all jobs
 
 	# Check OSM username/password
 
+	upload_queue = queue.Queue(maxsize=upload_queue_size)  # Changesets for background upload
+	upload_lock = threading.Lock()  # Lock for pending_uploads and resume file
+	upload_thread = None
+	upload_error = None  # Entity name of failed upload
+	pending_uploads = []  # Parts not yet uploaded, as saved in resume file
+	not_uploaded = []  # Counties/municipalities not uploaded because of failed upload
+	upload_history = []  # Element ids and end time of each upload job, for wait_for_uploads()
+
+	if discard and os.path.isfile(resume_filename):
+		file = open(resume_filename, encoding="utf-8")
+		discarded_ids = [ job['entity_id'] for job in json.load(file) if "entity_id" in job ]
+		file.close()
+		if discarded_ids and os.path.isdir(state_folder):  # Process discarded counties/municipalities again in incremental mode
+			for filename in os.listdir(state_folder):
+				if filename.startswith(tuple(discarded_ids)):
+					os.remove(os.path.join(state_folder, filename))
+		os.remove(resume_filename)
+		message ("Discarded changes of interrupted upload in '%s'\n" % resume_filename)
+
 	if upload:
 		osm_request_header = get_token()
+		if os.path.isfile(resume_filename):
+			resume_upload()
 
 	# Load municipality id's and names from Kartverket api
 
 	message ("Loading municipality and county codes from Kartverket\n")
-	file = open_url("https://ws.geonorge.no/kommuneinfo/v1/kommuner")
+	file = open(load_cached_file("https://ws.geonorge.no/kommuneinfo/v1/kommuner", "kommuner.json", max_age=registry_max_age),
+				encoding="utf-8")
 	municipality_data = json.load(file)
 	file.close()
 
@@ -869,7 +2014,8 @@ if __name__ == '__main__':
 
 	# Load county id's and names from Kartverket api
 
-	file = open_url("https://ws.geonorge.no/kommuneinfo/v1/fylker")
+	file = open(load_cached_file("https://ws.geonorge.no/kommuneinfo/v1/fylker", "fylker.json", max_age=registry_max_age),
+				encoding="utf-8")
 	county_data = json.load(file)
 	file.close()
 
@@ -878,28 +2024,46 @@ if __name__ == '__main__':
 		county[ coun['fylkesnummer'] ] = coun['fylkesnavn'].strip()
 	county['21'] = "Svalbard"
 
-	# Load corrections from Github
+	# Load corrections from Github, or use corrections included with addr2osm if not available
+
+	message ("Loading street name corrections\n")
+	folder = os.path.dirname(os.path.abspath(__file__))
 
-	message ("Loading street name corrections from addr2osm on Github\n")
-	filename = "https://raw.githubusercontent.com/NKAmapper/addr2osm/master/corrections.json"
-	file = open_url(filename)
+	filename = load_cached_file("https://raw.githubusercontent.com/NKAmapper/addr2osm/master/corrections.json", "corrections.json",
+								max_age=registry_max_age, fallback=os.path.join(folder, "corrections.json"))
+	file = open(filename, encoding="utf-8")
 	corrections = json.load(file)
 	file.close()
 
 	used_corrections = set()  # Will contain corrections used
 
-	filename = "https://raw.githubusercontent.com/NKAmapper/addr2osm/master/corrections_ending.json"
-	file = open_url(filename)
+	filename = load_cached_file("https://raw.githubusercontent.com/NKAmapper/addr2osm/master/corrections_ending.json", "corrections_ending.json",
+								max_age=registry_max_age, fallback=os.path.join(folder, "corrections_ending.json"))
+	file = open(filename, encoding="utf-8")
 	ending_corrections = json.load(file)
 	file.close()
 
 	all_used_corrections = {}
 
+	# Load OSM addresses for all municipalities from local OSM extract, or from one Overpass query for the entire country
+
+	osm_partitions = None
+	if pbf_filename:
+		if not os.path.isfile(pbf_filename):
+			sys.exit ("OSM extract '%s' not found" % pbf_filename)
+		osm_partitions = load_pbf(pbf_filename, children=(not upload or debug), boundary_municipality=boundary_municipality)
+	elif country:
+		osm_partitions = load_overpass_country(children=(not upload or debug))
+
 	# Process either one municipality or all municipalities in one county.
 	# Uploading to OSM either per municipality or per county.
 
 	osm_id = -1000
-	not_uploaded = []  # Will contain counties/municipalities not uploaded due to changeset size
+
+	atexit.register(remove_temporary_files)
+
+	if upload and save_new_deleted:
+		save_file = open_osm_file("new_deleted_addresses.%i.tmp" % os.getpid())  # Streamed file with all new and deleted addresses
 
 	if len(entity) == 4:
 		if entity not in municipality:
@@ -910,6 +2074,7 @@ if __name__ == '__main__':
 		init_root()
 		process_municipality (entity)
 		upload_changeset(entity, entity_name, uploaded)
+		finish_uploads()
 		log (action="close")
 		message ("\n")
 
@@ -927,6 +2092,21 @@ if __name__ == '__main__':
 		municipality_count = 0
 		total_uploaded = 0
 
+		# Start worker processes. Results are merged in the same order as sequential processing.
+
+		if jobs > 1:
+			municipality_ids = [ municipality_id for municipality_id in sorted(municipality.keys())
+								if (entity == "00" and municipality_id[0:2] in county or municipality_id[0:2] == entity)
+									and municipality_id >= first_municipality ]
+			file_log.flush()  # Forked workers must not inherit buffered output
+			if upload and save_new_deleted:
+				save_file['file'].flush()
+			pool = multiprocessing.Pool(jobs, initializer=init_worker,
+										initargs=((municipality, county, corrections, ending_corrections, upload, offline, incremental,
+												overpass_semaphore),))
+			results = pool.imap(process_worker, [ (municipality_id, single_partition(osm_partitions, municipality_id))
+													for municipality_id in municipality_ids ])
+
 		for county_id in sorted(county.keys()):
 			if entity == "00" or county_id == entity:
 				init_root()
@@ -934,7 +2114,10 @@ if __name__ == '__main__':
 
 				for municipality_id in sorted(municipality.keys()):
 					if municipality_id[0:2] == county_id and municipality_id >= first_municipality:
-						process_municipality (municipality_id)
+						if jobs > 1:
+							merge_municipality (next(results))
+						else:
+							process_municipality (municipality_id)
 						total_uploaded += uploaded
 						county_uploaded += uploaded
 						municipality_count += 1
@@ -947,24 +2130,23 @@ if __name__ == '__main__':
 					message ("\n\n")
 					upload_changeset(county_id, county[ county_id ], county_uploaded)
 
+		if jobs > 1:
+			pool.close()
+			pool.join()
+
+		finish_uploads()
+
 		message ("\nDone processing %i municipalities in %s, %i changes\n" % (municipality_count, entity_name, total_uploaded))
 		time_spent = time.time() - total_start_time
 		message ("Total time %i:%02d minutes\n\n" % (time_spent / 60, time_spent % 60))
 		log (action="close")
 
-		if not_uploaded:
-			message ("Upload these counties/municipalities manually (files have been generated):\n")
-			for line in not_uploaded:
-				message ("\t%s\n" % line)
-			message ("\n")
-
 	# Save file with new and deleted addresses (indication of buildings to be modified)
 
+	close_osm_file(osm_file)  # Discard if not saved
+
 	if upload and save_new_deleted:
-		save_tree = ET.ElementTree(save_root)
-		indent_tree(save_root)
-		out_filename = "new_deleted_addresses.osm"
-		save_tree.write(out_filename, encoding="utf-8", method="xml", xml_declaration=True)
+		close_osm_file(save_file, "new_deleted_addresses.osm")
 
 	# Report corrections used
 
@@ -0,0 +1,322 @@
+# -*- coding: utf8
+
+# addr2osm_extract.py
+# Partitioning of OSM addresses into municipalities, shared by addr2osm.py and addr2osm_sweden.py.
+# OSM data is loaded from a local OSM PBF extract (requires pyosmium and shapely), or by the scripts from one Overpass query
+# for the entire country (requires shapely).
+
+
+import sys
+
+
+
+# Output message
+
+def message (output_text):
+
+	sys.stdout.write (output_text)
+	sys.stdout.flush()
+
+
+
+# Return Overpass style element for OSM object from PBF file
+
+def pbf_element (obj, element_type):
+
+	element = {
+		'type': element_type,
+		'id': obj.id,
+		'timestamp': obj.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+		'version': obj.version,
+		'changeset': obj.changeset,
+		'user': obj.user,
+		'uid': obj.uid
+	}
+
+	if element_type == "node":
+		element['lat'] = obj.location.lat
+		element['lon'] = obj.location.lon
+
+	elif element_type == "way":
+		element['nodes'] = [ node.ref for node in obj.nodes ]
+
+	elif element_type == "relation":
+		member_types = { 'n': "node", 'w': "way", 'r': "relation" }
+		element['members'] = [ { 'type': member_types[ member.type ], 'ref': member.ref, 'role': member.role } for member in obj.members ]
+
+	if len(obj.tags):
+		element['tags'] = { tag.k: tag.v for tag in obj.tags }
+
+	return element
+
+
+
+# Load OSM addresses, parents and optionally children for all municipalities from local OSM PBF extract,
+# and partition them into municipalities using municipality boundaries from the same file.
+# Addresses and parents are loaded in one pass. A second pass is needed for children and for the center of relations.
+# Parameters:
+# - children: True if children ("recurse down") are needed
+# - boundary_municipality: Function returning municipality id for tags of boundary relation, or None
+
+def load_pbf (filename, children, boundary_municipality):
+
+	try:
+		import osmium  # Only needed for OSM extract
+		import shapely
+	except ImportError:
+		sys.exit ("Please install pyosmium and shapely to load OSM extract")
+
+	message ("Loading OSM addresses from '%s'... " % filename)
+
+	reader = osmium.io.Reader(filename, osmium.osm.osm_entity_bits.NOTHING)
+	osm_base = reader.header().get("osmosis_replication_timestamp") or None
+	reader.close()
+
+	addresses = []
+	address_keys = set()	# (type, id) of addresses
+	parents = []
+	parent_ways = set()		# id of ways in parents
+	boundaries = {}			# Geometry of municipality boundaries
+	wkb_factory = osmium.geom.WKBFactory()
+
+	processor = osmium.FileProcessor(filename).with_locations().with_areas(osmium.filter.TagFilter(("boundary", "administrative")))
+
+	for obj in processor:
+		object_type = obj.type_str()
+
+		if object_type == "a":
+			if not obj.from_way():
+				municipality_id = boundary_municipality({ tag.k: tag.v for tag in obj.tags })
+				if municipality_id:
+					try:
+						boundaries[ municipality_id ] = shapely.from_wkb(wkb_factory.create_multipolygon(obj))
+					except RuntimeError as e:  # Invalid or incomplete boundary geometry
+						message ("\n\t*** Skipping boundary of municipality %s (relation %i): %s\n" % (municipality_id, obj.orig_id(), str(e)))
+			continue
+
+		is_address = any("addr:" in tag.k for tag in obj.tags)  # Same as Overpass query
+
+		if object_type == "n":
+			if is_address:
+				addresses.append(pbf_element(obj, "node"))
+				address_keys.add(("node", obj.id))
+
+		elif object_type == "w":
+			refs = [ ("node", node.ref) for node in obj.nodes ]
+			if is_address:
+				element = pbf_element(obj, "way")
+				locations = [ node.location for node in obj.nodes if node.location.valid() ]
+				if locations:
+					element['center'] = {
+						'lat': round((min(location.lat for location in locations) + max(location.lat for location in locations)) / 2, 7),
+						'lon': round((min(location.lon for location in locations) + max(location.lon for location in locations)) / 2, 7)
+					}
+				addresses.append(element)
+				address_keys.add(("way", obj.id))
+
+			if any(ref in address_keys for ref in refs):
+				parents.append(pbf_element(obj, "way"))
+				parent_ways.add(obj.id)
+
+		elif object_type == "r":
+			element = pbf_element(obj, "relation")
+			if is_address:
+				addresses.append(element)
+				address_keys.add(("relation", obj.id))
+
+			# Same as Overpass "<", which includes relations with parent ways but not relations with relation members
+
+			if any(member['type'] != "relation" and (member['type'], member['ref']) in address_keys
+					or member['type'] == "way" and member['ref'] in parent_ways for member in element['members']):
+				parents.append(element)
+
+	# Second pass for children of addresses, and for node and way members of relations to get their center.
+	# A third pass is needed for nodes of ways in relations, which are also children in Overpass "recurse down".
+	# Relation members are not children, same as Overpass "recurse down".
+
+	needed = set()
+	for element in addresses:
+		if element['type'] == "way" and children:
+			needed.update(("node", ref) for ref in element['nodes'])
+		elif element['type'] == "relation":
+			needed.update((member['type'], member['ref']) for member in element['members'] if member['type'] != "relation")
+
+	found = {}
+	bounds = {}  # Bounding box of member ways (min lon, min lat, max lon, max lat)
+
+	if needed:
+		for obj in osmium.FileProcessor(filename).with_locations():
+			object_type = { 'n': "node", 'w': "way", 'r': "relation" }[ obj.type_str() ]
+			if (object_type, obj.id) in needed:
+				found[ (object_type, obj.id) ] = pbf_element(obj, object_type)
+				if object_type == "way":
+					locations = [ node.location for node in obj.nodes if node.location.valid() ]
+					if locations:
+						bounds[ obj.id ] = (min(location.lon for location in locations), min(location.lat for location in locations),
+											max(location.lon for location in locations), max(location.lat for location in locations))
+
+	if children:
+		needed = set()
+		for element in addresses:
+			if element['type'] == "relation":
+				for member in element['members']:
+					if member['type'] == "way" and ("way", member['ref']) in found:
+						needed.update(("node", ref) for ref in found[ ("way", member['ref']) ]['nodes'])
+		needed.difference_update(found.keys())
+
+		if needed:
+			for obj in osmium.FileProcessor(filename, osmium.osm.NODE):
+				if ("node", obj.id) in needed:
+					found[ ("node", obj.id) ] = pbf_element(obj, "node")
+
+	for element in addresses:
+		if element['type'] == "relation":
+			member_bounds = []
+			for member in element['members']:
+				if member['type'] == "node" and ("node", member['ref']) in found:
+					node = found[ ("node", member['ref']) ]
+					member_bounds.append((node['lon'], node['lat'], node['lon'], node['lat']))
+				elif member['type'] == "way" and member['ref'] in bounds:
+					member_bounds.append(bounds[ member['ref'] ])
+			if member_bounds:
+				element['center'] = {
+					'lat': round((min(bound[1] for bound in member_bounds) + max(bound[3] for bound in member_bounds)) / 2, 7),
+					'lon': round((min(bound[0] for bound in member_bounds) + max(bound[2] for bound in member_bounds)) / 2, 7)
+				}
+
+	message ("%i addresses, %i parents, %i municipality boundaries\n" % (len(addresses), len(parents), len(boundaries)))
+
+	data = {
+		'osm_base': osm_base,
+		'addresses': [ element for element in addresses if element['type'] == "node" or "center" in element ],
+		'parents': parents,
+		'children': list(found.values()) if children else None
+	}
+
+	return partition_osm_data(data, boundaries)
+
+
+
+# Partition OSM addresses into municipalities by location of node or center inside municipality boundaries,
+# together with their parents ("recurse up") and children ("recurse down").
+# Returns dict with partitions per municipality id, to be used by get_partition().
+
+def partition_osm_data (data, boundaries):
+
+	import shapely
+
+	municipality_ids = list(boundaries.keys())
+	tree = shapely.STRtree([ boundaries[ municipality_id ] for municipality_id in municipality_ids ])
+
+	points = shapely.points([ (element['lon'], element['lat']) if element['type'] == "node" else (element['center']['lon'], element['center']['lat'])
+								for element in data['addresses'] ])
+	point_index, boundary_index = tree.query(points, predicate="intersects")
+
+	# Index parents and children per address
+
+	parent_index = {}
+	for element in data['parents']:
+		if element['type'] == "way":
+			refs = set(("node", ref) for ref in element['nodes'])
+		else:
+			refs = set((member['type'], member['ref']) for member in element['members'])
+		for ref in refs:
+			if ref not in parent_index:
+				parent_index[ ref ] = []
+			parent_index[ ref ].append(element)
+
+	if data['children'] is not None:
+		children = { (element['type'], element['id']): element for element in data['children'] }
+
+	# Assign to municipalities. Elements on a common border are included in both municipalities, like Overpass.
+
+	partitions = {}
+	type_order = { "node": 0, "way": 1, "relation": 2 }  # Same order as Overpass output
+
+	for i, j in sorted(zip(point_index, boundary_index)):
+		element = data['addresses'][ i ]
+		municipality_id = municipality_ids[ j ]
+		if municipality_id not in partitions:
+			partitions[ municipality_id ] = { 'addresses': [], 'parents': {}, 'children': {} }
+		partition = partitions[ municipality_id ]
+		partition['addresses'].append(element)
+
+		key = (element['type'], element['id'])
+		for parent in parent_index.get(key, []):
+			partition['parents'][ (parent['type'], parent['id']) ] = parent
+			if parent['type'] == "way":
+				for grandparent in parent_index.get(("way", parent['id']), []):
+					partition['parents'][ (grandparent['type'], grandparent['id']) ] = grandparent
+
+		if data['children'] is not None:
+			if element['type'] == "way":
+				refs = [ ("node", ref) for ref in element['nodes'] ]
+			elif element['type'] == "relation":
+				refs = [ (member['type'], member['ref']) for member in element['members'] if member['type'] != "relation" ]
+				for member in element['members']:
+					if member['type'] == "way" and ("way", member['ref']) in children:
+						refs.extend(("node", ref) for ref in children[ ("way", member['ref']) ]['nodes'])
+			else:
+				refs = []
+			for ref in refs:
+				if ref in children:
+					partition['children'][ ref ] = children[ ref ]
+
+	for partition in partitions.values():
+		for result_set in ["parents", "children"]:
+			partition[ result_set ] = [ partition[ result_set ][ key ]
+										for key in sorted(partition[ result_set ], key=lambda key: (type_order[ key[0] ], key[1])) ]
+
+	return { 'osm_base': data['osm_base'], 'municipalities': partitions }
+
+
+
+# Return addresses, parents and optionally children of municipality from partitioned OSM data,
+# in the same format as load_overpass_combined(). Elements are not modified, since addresses are copied into compact columns.
+
+def get_partition (partitions, municipality_id, children):
+
+	partition = partitions['municipalities'].get(municipality_id, { 'addresses': [], 'parents': [], 'children': [] })
+
+	osm_data = { 'osm3s': { 'timestamp_osm_base': partitions['osm_base'] }, 'elements': list(partition['addresses']) }
+	osm_parents = { 'elements': partition['parents'] }
+	osm_children = { 'elements': partition['children'] if children else [] }
+
+	return osm_data, osm_parents, osm_children
+
+
+
+# Return partitioned OSM data with only one municipality, to be passed to the worker process for the municipality
+
+def single_partition (partitions, municipality_id):
+
+	if partitions is None:
+		return None
+
+	municipalities = {}
+	if municipality_id in partitions['municipalities']:
+		municipalities[ municipality_id ] = partitions['municipalities'][ municipality_id ]
+
+	return { 'osm_base': partitions['osm_base'], 'municipalities': municipalities }
+
+
+
+# Return polygon for boundary relation from Overpass "out geom", assembled from the member ways.
+# Inner rings are removed from the outer rings.
+
+def boundary_polygon (relation):
+
+	import shapely
+
+	rings = { 'outer': [], 'inner': [] }
+	for member in relation['members']:
+		if member['type'] == "way" and len(member.get('geometry', [])) > 1:
+			line = shapely.LineString([ (point['lon'], point['lat']) for point in member['geometry'] ])
+			rings[ "inner" if member['role'] == "inner" else "outer" ].append(line)
+
+	polygon = shapely.union_all(shapely.get_parts(shapely.polygonize(shapely.get_parts(shapely.union_all(rings['outer'])))))
+	if rings['inner']:
+		holes = shapely.union_all(shapely.get_parts(shapely.polygonize(shapely.get_parts(shapely.union_all(rings['inner'])))))
+		polygon = shapely.difference(polygon, holes)
+
+	return polygon
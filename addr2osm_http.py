@@ -0,0 +1,197 @@
+# -*- coding: utf8
+
+# addr2osm_http.py
+# Keep-alive HTTP client shared by addr2osm.py and addr2osm_sweden.py.
+# Responses are streamed to the caller, gzip/deflate decoded on the fly, so that large files are not kept in memory.
+
+
+import io
+import os
+import select
+import threading
+import zlib
+import http.client
+import urllib.request, urllib.parse, urllib.error
+
+
+
+http_pool = { 'pid': None, 'connections': {}, 'lock': None }  # Idle keep-alive connections per (scheme, host) in process
+
+
+
+# Get idle connection to host from connection pool, or open new connection.
+# Connections are only reused within the same process, and only if not closed by the server while idle.
+
+def get_connection (scheme, host):
+
+	if http_pool['pid'] != os.getpid():  # Do not share sockets with parent process
+		http_pool.update({ 'pid': os.getpid(), 'connections': {}, 'lock': threading.Lock() })
+
+	with http_pool['lock']:
+		idle_connections = http_pool['connections'].setdefault((scheme, host), [])
+		while idle_connections:
+			connection = idle_connections.pop()
+			if connection.sock is not None and not select.select([ connection.sock ], [], [], 0)[0]:
+				return connection, True
+			connection.close()  # Closed by server or unread data
+
+	proxy = urllib.request.getproxies().get(scheme)
+	if proxy and not urllib.request.proxy_bypass(host.split(":")[0]):
+		proxy_host = urllib.parse.urlsplit(proxy).netloc
+		if scheme == "https":
+			connection = http.client.HTTPSConnection(proxy_host)
+			connection.set_tunnel(host)
+		else:
+			connection = http.client.HTTPConnection(proxy_host)
+		connection.proxy = True
+	else:
+		connection = http.client.HTTPSConnection(host) if scheme == "https" else http.client.HTTPConnection(host)
+		connection.proxy = False
+
+	return connection, False
+
+
+
+# Return connection to connection pool after the response has been read, or close it.
+
+def release_connection (scheme, host, connection, response):
+
+	if response.isclosed() and not response.will_close:  # Body read completely and keep-alive
+		if http_pool['pid'] == os.getpid():
+			with http_pool['lock']:
+				http_pool['connections'].setdefault((scheme, host), []).append(connection)
+			return
+	connection.close()
+
+
+
+# File object for streaming response body, with the same headers, status and url attributes as urllib.request.urlopen().
+# Body is gzip/deflate decoded while reading. The connection is returned to the pool by close().
+
+class ResponseFile (io.RawIOBase):
+
+	def __init__ (self, connection, response, url, scheme, host):
+
+		self.connection = connection
+		self.response = response
+		self.headers = response.headers
+		self.status = response.status
+		self.reason = response.reason
+		self.url = url
+		self.pool_key = (scheme, host)
+
+		encoding = response.getheader("Content-Encoding", "").lower()
+		if encoding == "gzip":
+			self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		elif encoding == "deflate":
+			self.decoder = zlib.decompressobj()
+		else:
+			self.decoder = None
+		self.checked = encoding != "deflate"  # Deflate may be sent with or without zlib header, checked at first chunk
+		self.pending = b""  # Decoded data not yet returned
+		self.offset = 0
+
+
+	def readable (self):
+		return True
+
+
+	def readinto (self, buffer):
+
+		if self.decoder is None:
+			return self.response.readinto(buffer)
+
+		while self.offset == len(self.pending):
+			chunk = self.response.read(max(len(buffer), 8192))
+			if not chunk:
+				self.pending = self.decoder.flush()
+				self.offset = 0
+				if not self.pending:
+					return 0
+				break
+
+			try:
+				self.pending = self.decoder.decompress(chunk)
+			except zlib.error:
+				if self.checked:
+					raise
+				self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)  # Raw deflate without zlib header
+				self.pending = self.decoder.decompress(chunk)
+			self.checked = True
+			self.offset = 0
+
+		size = min(len(buffer), len(self.pending) - self.offset)
+		buffer[ : size ] = memoryview(self.pending)[ self.offset : self.offset + size ]
+		self.offset += size
+		return size
+
+
+	def close (self):
+
+		if not self.closed:
+			release_connection(*self.pool_key, self.connection, self.response)
+		super().close()
+
+
+
+# Send request on persistent (keep-alive) connection and return streaming response file.
+# Same behaviour as urllib.request.urlopen(): Redirects are followed, URLError is raised for connection errors
+# and HTTPError for HTTP status codes from 300. The caller must close the returned file to reuse the connection.
+
+def http_open (request):
+
+	if isinstance(request, str):
+		request = urllib.request.Request(request)
+
+	url = request.full_url
+	method = request.get_method()
+	data = request.data
+	headers = dict(request.header_items())
+	headers['Accept-Encoding'] = "gzip, deflate"
+	if data is not None and not any(key.lower() == "content-type" for key in headers):
+		headers['Content-Type'] = "application/x-www-form-urlencoded"  # Same default as urllib
+
+	for redirect in range(5):
+		split_url = urllib.parse.urlsplit(url)
+		connection, reused = get_connection(split_url.scheme, split_url.netloc)
+		path = url if connection.proxy and split_url.scheme == "http" else urllib.parse.urlunsplit(("", "", split_url.path or "/", split_url.query, ""))
+
+		try:
+			connection.request(method, path, body=data, headers=headers)
+			response = connection.getresponse()
+		except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+			connection.close()
+			if not reused or method != "GET":  # Only retry idempotent requests on connection closed while idle
+				raise urllib.error.URLError(e)
+			connection, reused = get_connection(split_url.scheme, split_url.netloc)
+			try:
+				connection.request(method, path, body=data, headers=headers)
+				response = connection.getresponse()
+			except (OSError, http.client.HTTPException) as e:
+				connection.close()
+				raise urllib.error.URLError(e)
+		except (OSError, http.client.HTTPException) as e:
+			connection.close()
+			raise urllib.error.URLError(e)
+
+		file = ResponseFile(connection, response, url, split_url.scheme, split_url.netloc)
+
+		if response.status < 300:
+			return file
+
+		# Redirect and error responses are small, so read them completely and release the connection
+
+		body = file.read()
+		file.close()
+
+		if response.status in [301, 302, 303, 307, 308] and response.getheader("Location"):
+			url = urllib.parse.urljoin(url, response.getheader("Location"))
+			if response.status == 303 or response.status in [301, 302] and method == "POST":
+				method = "GET"
+				data = None
+				headers = { key: value for key, value in headers.items() if key.lower() not in ["content-type", "content-length"] }
+			continue
+
+		raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+	raise urllib.error.HTTPError(url, response.status, "Too many redirects", response.headers, io.BytesIO(body))
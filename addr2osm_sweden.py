@@ -7,6 +7,10 @@
 # Optional "-upload" parameter will ask for username/password and upload to OSM,
 # otherwise saves address changes to file with added DELETE tag + include surplus addr objects.
 # Optional "-source" paramter will just save Lantmäteriet addresses to file without uplaod.
+# Optional "-jobs <n>" parameter will process n municipalities concurrently for county or country.
+# Optional "-pbf <file>" parameter will load OSM addresses from a local OSM extract (requires pyosmium and shapely).
+# Optional "-country" parameter will load OSM addresses for the entire country ("Sverige") in one Overpass query (requires shapely).
+# Optional "-discard" parameter will drop changes of an interrupted upload instead of uploading them with "-upload".
 
 
 import json
@@ -17,8 +21,23 @@ import os.path
 import sys
 import math
 import time
+import shutil
+import hashlib
+import atexit
+import pickle
+import tempfile
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import threading
+import queue
+from array import array
 from xml.etree import ElementTree as ET
+from addr2osm_http import http_open
+from addr2osm_extract import load_pbf, partition_osm_data, get_partition, single_partition, boundary_polygon
 from geopandas import gpd
+import pandas as pd
+import numpy as np
 import warnings
 
 warnings.filterwarnings(
@@ -37,7 +56,8 @@ username = "addr2osm"			# Upload to OSM with this account
 
 max_retries = 6 				# Max number of retries for Overpass API
 
-changeset_area = "municipality"	# Changeset partiion - "county" or "municipality". Note max 9900 changeset size.
+changeset_area = "municipality"	# Changeset partiion - "county" or "municipality". Larger changes are split into several changesets.
+max_changeset_size = 9900 		# Max number of elements per changeset (OSM API limit is 10.000)
 
 max_relocation = 25  			# Maximum relocation for an addr node (meters)
 min_relocation = 1 				# Minimum relocation
@@ -50,9 +70,19 @@ request_header = {"User-Agent": "addr2osm/" + version}
 
 osm_api = "https://api.openstreetmap.org/api/0.6/"  # Production database
 overpass_api = "https://overpass-api.de/api/interpreter"
+overpass_slots = 2 				# Max number of concurrent Overpass queries in total, across all jobs (limited slots per IP address)
+overpass_combined = False		# Load addresses, parents and children in one combined Overpass query instead of three
+osm_snapshot = False			# Keep snapshot of OSM addresses per municipality in cache folder, and only load changes since last run
 
 osm_token_filename = "~/Google Drive/Min disk/diverse/Adresser/addr2osm_token.txt"  # OAuth2 access token for OSM
 lm_token_filename = "~/downloads/geotorget_token.txt"	# Stored Geotorget credentials
+resume_filename = "upload_resume.json"	# Parts of changes not yet uploaded, for resuming interrupted upload
+upload_queue_size = 1 			# Max number of changesets waiting for background upload while next county/municipality is processed
+upload_wait = 60 				# Seconds to wait before loading OSM data again, until Overpass includes changes uploaded in the background
+max_upload_waits = 10 			# Max number of times to wait for Overpass to include changes uploaded in the background
+
+cache_folder = "cache"			# Folder for cached Lantmäteriet files, parsed addresses and registries
+registry_max_age = 7 * 24 * 3600	# Seconds before cached municipality/county registries are revalidated
 
 
 
@@ -69,6 +99,103 @@ def compute_distance (p1, p2):
 
 
 
+# Compute approximation of distances between two arrays of coordinates, in meters, in one vectorised operation.
+# Same approximation as compute_distance().
+# Format: Sequences of (lon, lat)
+
+def compute_distances (points1, points2):
+
+	p1 = np.radians(np.array(points1, dtype=float).reshape(-1, 2))
+	p2 = np.radians(np.array(points2, dtype=float).reshape(-1, 2))
+	x = (p2[:,0] - p1[:,0]) * np.cos( 0.5*(p2[:,1] + p1[:,1]) )
+	y = p2[:,1] - p1[:,1]
+	return 6371000 * np.sqrt( x*x + y*y )
+
+
+
+# Build index of OSM address nodes at given positions in compact columns per normalised house number, with a spatial grid for each house number.
+# Cells are at least cell_size meters wide and high, so any node within cell_size meters is in one of the 3x3 neighbour cells.
+# Each cell contains a dict of coordinates keyed by position, to allow fast removal and stable tie breaking.
+
+def build_grid (elements, positions, cell_size):
+
+	max_lat = 0
+	for i in positions:
+		max_lat = max(max_lat, abs(elements['lat'][ i ]))
+
+	lat_size = math.degrees(cell_size / 6371000)
+	lon_size = lat_size / math.cos(math.radians(min(max_lat + 0.1, 89)))  # Margin for points just north of the northernmost node
+
+	grid = {
+		'lat_size': lat_size,
+		'lon_size': lon_size,
+		'cell_size': cell_size,
+		'cells': {}
+	}
+
+	for i in positions:
+		if "addr:housenumber" in elements['tags'][ i ]:
+			point = (elements['lon'][ i ], elements['lat'][ i ])
+			cell = grid_cell(grid, housenumber_key(elements['tags'][ i ]['addr:housenumber']), point)
+			if cell not in grid['cells']:
+				grid['cells'][ cell ] = {}
+			grid['cells'][ cell ][ i ] = point
+
+	return grid
+
+
+
+# Normalise house number for matching
+
+def housenumber_key (housenumber):
+
+	return housenumber.replace(" ", "").upper()
+
+
+
+# Return grid cell for house number and coordinate.
+# Format: (lon, lat)
+
+def grid_cell (grid, housenumber, point):
+
+	return (housenumber, int(math.floor(point[0] / grid['lon_size'])), int(math.floor(point[1] / grid['lat_size'])))
+
+
+
+# Return position of nearest node with given house number closer than cell_size meters, or None if not found.
+# Ties are resolved to the first position.
+
+def grid_nearest (grid, housenumber, point):
+
+	best_distance = grid['cell_size']
+	best_index = None
+	housenumber, lon_cell, lat_cell = grid_cell(grid, housenumber, point)
+
+	for lon_step in [-1, 0, 1]:
+		for lat_step in [-1, 0, 1]:
+			cell = (housenumber, lon_cell + lon_step, lat_cell + lat_step)
+			if cell in grid['cells']:
+				for i, node_point in grid['cells'][ cell ].items():
+					distance = compute_distance(point, node_point)
+					if distance < best_distance or distance == best_distance and best_index is not None and i < best_index:
+						best_distance = distance
+						best_index = i
+
+	return best_index
+
+
+
+# Remove node at position in compact columns from grid. Must be done before tags or coordinates are modified.
+
+def grid_remove (grid, elements, index):
+
+	cell = grid_cell(grid, housenumber_key(elements['tags'][ index ]['addr:housenumber']), (elements['lon'][ index ], elements['lat'][ index ]))
+	del grid['cells'][ cell ][ index ]
+	if not grid['cells'][ cell ]:
+		del grid['cells'][ cell ]
+
+
+
 # Open file/api, try up to 5 times, each time with double sleep time
 
 def open_url (url):
@@ -76,7 +203,7 @@ def open_url (url):
 	tries = 0
 	while tries < max_retries:
 		try:
-			return urllib.request.urlopen(url)
+			return http_open(url)
 		except urllib.error.HTTPError as e:
 			if e.code in [429, 503, 504]:  # Too many requests, Service unavailable or Gateway timed out
 				if tries  == 0:
@@ -100,6 +227,270 @@ def open_url (url):
 
 
 
+# Load file from url into cache folder and return filename of cached file.
+# Cached file is revalidated with ETag/Last-Modified, unless it is younger than max_age seconds.
+# Cached file is used if there is no network. HTTP errors are raised to caller.
+
+def load_cached_file (url, filename, header, max_age=None):
+
+	cache_filename = os.path.join(cache_folder, filename)
+	meta_filename = cache_filename + ".json"
+
+	if (max_age is not None and os.path.isfile(cache_filename)
+			and time.time() - os.path.getmtime(cache_filename) < max_age):
+		return cache_filename
+
+	header = header.copy()
+	if os.path.isfile(cache_filename) and os.path.isfile(meta_filename):
+		file = open(meta_filename)
+		meta = json.load(file)
+		file.close()
+		if "etag" in meta:
+			header['If-None-Match'] = meta['etag']
+		if "last_modified" in meta:
+			header['If-Modified-Since'] = meta['last_modified']
+
+	request = urllib.request.Request(url, headers=header)
+	try:
+		file_in = http_open(request)
+	except urllib.error.HTTPError as e:
+		if e.code == 304:  # Not modified
+			os.utime(cache_filename)  # Restart max_age
+			return cache_filename
+		raise
+	except urllib.error.URLError:  # No network
+		if os.path.isfile(cache_filename):
+			return cache_filename
+		raise
+
+	# Save to temporary file first, to avoid partial files in cache
+
+	os.makedirs(cache_folder, exist_ok=True)
+	temp_filename = "%s.%i.tmp" % (cache_filename, os.getpid())
+	file_out = open(temp_filename, "wb")
+	shutil.copyfileobj(file_in, file_out)
+	file_out.close()
+	os.replace(temp_filename, cache_filename)
+
+	meta = {}
+	if file_in.headers.get("ETag"):
+		meta['etag'] = file_in.headers.get("ETag")
+	if file_in.headers.get("Last-Modified"):
+		meta['last_modified'] = file_in.headers.get("Last-Modified")
+	file_in.close()
+
+	file = open(meta_filename, "w")
+	json.dump(meta, file)
+	file.close()
+
+	return cache_filename
+
+
+
+# Return SHA-256 hash of file content
+
+def hash_file (filename):
+
+	file_hash = hashlib.sha256()
+	file = open(filename, "rb")
+	for chunk in iter(lambda: file.read(1024 * 1024), b""):
+		file_hash.update(chunk)
+	file.close()
+	return file_hash.hexdigest()
+
+
+
+# Load Overpass query and return json data.
+# Optionally retry up to 5 times if the result is empty (load could be empty from Overpass).
+
+def load_overpass (query, retry_empty=False):
+
+	count = 0
+	data = { 'elements': [] }
+	while not data['elements'] and count < (5 if retry_empty else 1):
+		request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
+		with overpass_semaphore:  # Shared by all worker processes
+			file = open_url(request)
+			data = json.load(file)
+			file.close()
+		count += 1
+
+	return data
+
+
+
+# Load addresses, parents ("recurse up") and optionally children ("recurse down") in one combined Overpass query.
+# The query must contain the address union statement followed by "out center meta".
+# Result sets are separated by "make" elements in the response. Retry up to 5 times if no addresses (load could be empty).
+
+def load_overpass_combined (query, children):
+
+	combined_query = query.replace("(area.a););", "(area.a);)->.addr;")
+	combined_query = combined_query.replace("out center meta;",
+						".addr out center meta;make parents;out;.addr <;out meta;"
+						+ ("make children;out;.addr >;out meta;" if children else ""))
+
+	count = 0
+	osm_data = { 'elements': [] }
+	while not osm_data['elements'] and count < 5:
+		data = load_overpass(combined_query)
+		result = { 'addresses': [], 'parents': [], 'children': [] }
+		result_set = "addresses"
+		for element in data['elements']:
+			if element['type'] in result:  # Separator
+				result_set = element['type']
+			else:
+				result[ result_set ].append(element)
+
+		osm_data = data
+		osm_data['elements'] = result['addresses']
+		count += 1
+
+	return osm_data, { 'elements': result['parents'] }, { 'elements': result['children'] }
+
+
+
+# Load addresses, parents and optionally children from local snapshot of municipality in cache folder, patched with changes.
+# Only elements changed since the timestamp of the snapshot are loaded from Overpass ("newer"), together with ids of all
+# current elements to discover deleted elements. The full combined query is used if there is no usable snapshot.
+# Returns the same result as load_overpass_combined(), and saves the new snapshot.
+
+def load_overpass_snapshot (query, municipality_id, children):
+
+	snapshot_filename = os.path.join(cache_folder, "osm_%s.json" % municipality_id)
+	result = None
+
+	if os.path.isfile(snapshot_filename):
+		file = open(snapshot_filename, encoding="utf-8")
+		snapshot = json.load(file)
+		file.close()
+
+		if not children or snapshot['children'] is not None:
+			diff_query = query.replace("(area.a););", "(area.a);)->.addr;")
+			diff_query = diff_query.replace("out center meta;",
+							('.addr out ids;make addresses;out;nwr.addr(newer:"{0}")->.changed;.changed out center meta;'
+							+ 'make parent_ids;out;.addr < ->.up;.up out ids;make parents;out;(.changed <;nwr.up(newer:"{0}"););out meta;'
+							+ ('make child_ids;out;.addr > ->.down;.down out ids;make children;out;(.changed >;nwr.down(newer:"{0}"););out meta;'
+								if children else "")).format(snapshot['osm_base']))
+
+			data = load_overpass(diff_query)
+			result = { 'address_ids': [], 'addresses': [], 'parent_ids': [], 'parents': [], 'child_ids': [], 'children': [] }
+			result_set = "address_ids"
+			for element in data['elements']:
+				if element['type'] in result:  # Separator
+					result_set = element['type']
+				else:
+					result[ result_set ].append(element)
+
+			# Patch snapshot. Use full query if elements have been added without being changed (e.g. new municipality boundary).
+
+			for result_set, id_set in [("addresses", "address_ids"), ("parents", "parent_ids"), ("children", "child_ids")]:
+				if result_set == "children" and not children:
+					result['children'] = None  # Not loaded, and not patched with changes
+					continue
+
+				ids = set((element['type'], element['id']) for element in result[ id_set ])
+				elements = { (element['type'], element['id']): element for element in snapshot[ result_set ] if (element['type'], element['id']) in ids }
+				for element in result[ result_set ]:
+					if (element['type'], element['id']) in ids:
+						elements[ (element['type'], element['id']) ] = element
+
+				if len(elements) < len(ids) or not ids and result_set == "addresses":
+					result = None
+					break
+
+				type_order = { "node": 0, "way": 1, "relation": 2 }  # Same order as Overpass output
+				result[ result_set ] = sorted(elements.values(), key=lambda element: (type_order[ element['type'] ], element['id']))
+
+	if result is None:
+		osm_data, osm_parents, osm_children = load_overpass_combined(query, children)
+		data = osm_data
+		result = {
+			'addresses': osm_data['elements'],
+			'parents': osm_parents['elements'],
+			'children': osm_children['elements'] if children else None
+		}
+	else:
+		osm_data = { 'osm3s': data['osm3s'], 'elements': result['addresses'] }
+		osm_parents = { 'elements': result['parents'] }
+		osm_children = { 'elements': result['children'] if children else [] }
+
+	# Save snapshot before elements are modified during matching
+
+	snapshot = {
+		'osm_base': data['osm3s']['timestamp_osm_base'],
+		'addresses': result['addresses'],
+		'parents': result['parents'],
+		'children': result['children']
+	}
+
+	os.makedirs(cache_folder, exist_ok=True)
+	temp_filename = "%s.%i.tmp" % (snapshot_filename, os.getpid())
+	file = open(temp_filename, "w", encoding="utf-8")
+	json.dump(snapshot, file, ensure_ascii=False)
+	file.close()
+	os.replace(temp_filename, snapshot_filename)
+
+	return osm_data, osm_parents, osm_children
+
+
+
+# Return municipality id for administrative boundary tags, or None.
+# Same boundaries as used in Overpass queries.
+
+def boundary_municipality (tags):
+
+	if tags.get("admin_level") == "7" and "ref:scb" in tags:
+		return tags['ref:scb']
+	else:
+		return None
+
+
+
+# Load OSM addresses, parents and optionally children for the entire country in one combined Overpass query,
+# and partition them into municipalities using municipality boundaries from Overpass.
+# Returns the same partitions as load_pbf(), avoiding one area query per municipality.
+
+def load_overpass_country (children):
+
+	if importlib.util.find_spec("shapely") is None:  # Only needed for partitioning
+		sys.exit ("Please install shapely to load OSM addresses for the entire country")
+
+	message ("Loading municipality boundaries from OSM Overpass... ")
+
+	area = '(area["ISO3166-1"="SE"][admin_level=2];)->.a;'
+	query = (	'[out:json][timeout:900];' + area +
+				'rel[boundary=administrative][admin_level=7]["ref:scb"](area.a);'
+				'out geom;' )
+
+	boundaries = {}
+	for element in load_overpass(query, retry_empty=True)['elements']:
+		municipality_id = boundary_municipality(element['tags'])
+		if municipality_id in municipalities:
+			boundaries[ municipality_id ] = boundary_polygon(element)
+
+	message ("%i\n" % len(boundaries))
+	message ("Loading existing addresses for entire country from OSM Overpass... ")
+
+	query = (	'[out:json][timeout:1800][maxsize:4000000000];' + area +
+				'(nwr[~"addr:"~".*"](area.a););'
+				'out center meta;' )
+
+	osm_data, osm_parents, osm_children = load_overpass_combined(query, children)
+
+	message ("%i addresses, %i parents\n" % (len(osm_data['elements']), len(osm_parents['elements'])))
+
+	data = {
+		'osm_base': osm_data.get('osm3s', {}).get('timestamp_osm_base'),
+		'addresses': [ element for element in osm_data['elements'] if element['type'] == "node" or "center" in element ],
+		'parents': osm_parents['elements'],
+		'children': osm_children['elements'] if children else None
+	}
+
+	return partition_osm_data(data, boundaries)
+
+
+
 # Output message
 
 def message (output_text):
@@ -119,7 +510,7 @@ def load_municipalities ():
 
 	url = "https://gist.githubusercontent.com/vincentorback/90c31b4231449a5d159ba29d3cafa441/raw/f3de36d70e75f1c67769c9c9abbaadee8bba3e23/municipalities.json"
 	try:
-		file = urllib.request.urlopen(url)
+		file = open(load_cached_file(url, "municipalities.json", request_header, max_age=registry_max_age), encoding="utf-8")
 	except urllib.error.HTTPError as e:
 		sys.exit("\t*** Failed to load municiaplity names from GitHub, HTTP error %i: %s\n\n" % (e.code, e.reason))
 	municipality_data = json.load(file)
@@ -133,7 +524,7 @@ def load_municipalities ():
 
 	url = "https://gist.githubusercontent.com/vincentorback/90c31b4231449a5d159ba29d3cafa441/raw/f3de36d70e75f1c67769c9c9abbaadee8bba3e23/counties.json"
 	try:
-		file = urllib.request.urlopen(url)
+		file = open(load_cached_file(url, "counties.json", request_header, max_age=registry_max_age), encoding="utf-8")
 	except urllib.error.HTTPError as e:
 		sys.exit("\t*** Failed to load county names from GitHub, HTTP error %i: %s\n\n" % (e.code, e.reason))
 	county_data = json.load(file)
@@ -250,10 +641,9 @@ def load_lm_addresses (municipality_id):
 	header = { 'Authorization': 'Basic ' +  lm_token }
 	url = "https://dl1.lantmateriet.se/adress/belagenhetsadresser/belagenhetsadresser_kn%s.zip" % municipality_id
 	filename = "belagenhetsadresser_kn%s.gpkg" % municipality_id
-	request = urllib.request.Request(url, headers = header)
 
 	try:
-		file_in = urllib.request.urlopen(request)
+		zip_filename = load_cached_file(url, "belagenhetsadresser_kn%s.zip" % municipality_id, header)
 	except urllib.error.HTTPError as e:
 		message ("\t*** HTTP error %i: %s\n" % (e.code, e.reason))
 		if e.code == 401:  # Unauthorized
@@ -265,120 +655,294 @@ def load_lm_addresses (municipality_id):
 		else:
 			return
 
-	zip_file = zipfile.ZipFile(io.BytesIO(file_in.read()))
-	file = zip_file.open(filename)
+	# Use parsed addresses from cache if source file and settings have not changed
 
-	gdf = gpd.read_file(file, layer="belagenhetsadress")
+	cache_key = (hash_file(zip_filename), include_housename)
+	pickle_filename = os.path.splitext(zip_filename)[0] + ".pickle"
 
-	file.close()
-	zip_file.close()
-	file_in.close()
+	if os.path.isfile(pickle_filename):
+		file = open(pickle_filename, "rb")
+		cache = pickle.load(file)
+		file.close()
+		if cache['key'] == cache_key:
+			lm_addresses = cache['addresses']
+			message ("%i (cached)\n" % len(lm_addresses))
+			return
 
-	gdf = gdf.to_crs("EPSG:4326")  # Transform projection from EPSG:3006
-	gdf['versiongiltigfran'] = gdf['versiongiltigfran'].dt.strftime("%Y-%m-%d")  # Fix type
+	# Extract GeoPackage to temporary folder and read only relevant columns and addresses.
+	# Use Arrow for faster reading if available.
 
-	# Load and tag addresses
+	columns = [ "adressplatstyp", "statusforbelagenhetsadress", "postnummer", "postort", "kommundel_faststalltnamn",
+				"adressomrade_faststalltnamn", "gardsadressomrade_faststalltnamn", "adressplatsnummer", "bokstavstillagg",
+				"avvikerfranstandarden", "avvikandeadressplatsbeteckning", "lagestillagg", "lagestillaggsnummer" ]
+	if include_housename:
+		columns.append("popularnamn")
 
-	lm_addresses = []
+	with tempfile.TemporaryDirectory() as temp_folder:
+		zip_file = zipfile.ZipFile(zip_filename)
+		gpkg_filename = zip_file.extract(filename, temp_folder)
+		zip_file.close()
 
-	for feature in gdf.iterfeatures(na="drop", drop_id=True):
-		properties = feature['properties']
-		point = feature['geometry']['coordinates']
-		tags = {}
+		gdf = gpd.read_file(gpkg_filename, layer="belagenhetsadress", engine="pyogrio", columns=columns,
+							where="statusforbelagenhetsadress = 'Gällande' AND postnummer <> 0 AND postort IS NOT NULL",
+							use_arrow=(importlib.util.find_spec("pyarrow") is not None))
 
-		# Skip incomplete data
-		if "postort" not in properties or properties['postnummer'] == 0 or properties['statusforbelagenhetsadress'] != "Gällande":
-			continue
+	gdf = gdf.to_crs("EPSG:4326")  # Transform projection from EPSG:3006
 
-		street = ""
-		if properties['adressplatstyp'] in ["Gatuadressplats", "Metertalsadressplats"]:
-			street = properties['adressomrade_faststalltnamn'].strip()
-			tags['addr:street'] = street
-		elif properties['adressplatstyp'] == "Byadressplats":
-			street = properties['adressomrade_faststalltnamn'].strip()
-			tags['addr:place'] = street
-		elif properties['adressplatstyp'] == "Gårdsadressplats":
-			street = properties['adressomrade_faststalltnamn'].strip()
-			if "gardsadressomrade_faststalltnamn" in properties and properties['gardsadressomrade_faststalltnamn']:
-				street += " " + properties['gardsadressomrade_faststalltnamn'].strip()
-			tags['addr:place'] = street
-
-		number = ""
-		if ("adressplatsnummer" in properties and properties['adressplatsnummer']
-				or properties['avvikerfranstandarden'] and properties['avvikandeadressplatsbeteckning']):
-
-			if properties['avvikerfranstandarden']:
-				number = properties['avvikandeadressplatsbeteckning'].strip()
-			else:
-				number = properties['adressplatsnummer'].strip()
+	# Skip incomplete data
+
+	gdf = gdf[ gdf['postort'].notna() & gdf['postnummer'].notna() & (gdf['postnummer'] != 0)
+				& (gdf['statusforbelagenhetsadress'] == "Gällande") ]
+
+	# Build address columns for all addresses in one go
 
-			if "bokstavstillagg" in properties and properties['bokstavstillagg']:
-				number += properties['bokstavstillagg']
-			if "lagestillagg" in properties and properties['lagestillagg']:
-				number += " " + properties['lagestillagg'].strip()
-				if "lagestillaggsnummer" in properties:
-					number += str(properties['lagestillaggsnummer'])
+	def text_column (name):  # Column as strings, with "" for missing values or columns
+		if name in gdf.columns:
+			return gdf[ name ].astype(object).where(gdf[ name ].notna(), "").map(str)
+		else:
+			return pd.Series("", index=gdf.index, dtype=object)
+
+	address_type = gdf['adressplatstyp']
+	street_key = address_type.map({
+		"Gatuadressplats": "addr:street",
+		"Metertalsadressplats": "addr:street",
+		"Byadressplats": "addr:place",
+		"Gårdsadressplats": "addr:place"
+	})
+
+	street = text_column("adressomrade_faststalltnamn").str.strip().where(street_key.notna(), "")
+	farm = text_column("gardsadressomrade_faststalltnamn")
+	street = street.mask((address_type == "Gårdsadressplats") & (farm != ""), street + " " + farm.str.strip())
+
+	deviating = gdf['avvikerfranstandarden'].fillna(False).astype(bool)
+	deviating_number = text_column("avvikandeadressplatsbeteckning")
+	standard_number = text_column("adressplatsnummer")
+	has_number = (standard_number != "") | (deviating & (deviating_number != ""))
+
+	number = standard_number.str.strip().mask(deviating, deviating_number.str.strip())
+	number = number + text_column("bokstavstillagg")
+	position = text_column("lagestillagg")
+	number = number.mask(position != "", number + " " + position.str.strip() + text_column("lagestillaggsnummer"))
+	number = number.where(has_number, "")
+
+	district = text_column("kommundel_faststalltnamn").str.strip()
+	postcode = gdf['postnummer'].astype(object).map(str)
+	city = text_column("postort").str.strip()
+
+	if include_housename:
+		housename = text_column("popularnamn").str.strip()
+	else:
+		housename = pd.Series("", index=gdf.index, dtype=object)
+
+	# Load and tag addresses
 
-			tags['addr:housenumber'] = number			
+	lm_addresses = []
 
-		tags['addr:district'] = properties['kommundel_faststalltnamn'].strip()
-		tags['addr:postcode'] = str(properties['postnummer'])
-		tags['addr:city'] = properties['postort'].strip()
+	for address_type, street_key, street, has_number, number, district, postcode, city, housename, lon, lat in zip(
+			address_type.tolist(), street_key.tolist(), street.tolist(), has_number.tolist(), number.tolist(),
+			district.tolist(), postcode.tolist(), city.tolist(), housename.tolist(), gdf.geometry.x.tolist(), gdf.geometry.y.tolist()):
 
-		if include_housename and "popularnamn" in properties and properties['popularnamn'].strip():
-			tags['addr:housename'] = properties['popularnamn'].strip()
+		tags = {}
+		if isinstance(street_key, str):
+			tags[ street_key ] = street
+		if has_number:
+			tags['addr:housenumber'] = number
+		tags['addr:district'] = district
+		tags['addr:postcode'] = postcode
+		tags['addr:city'] = city
+		if housename:
+			tags['addr:housename'] = housename
 
 		# Create index key for direct matching with OSM later
-		index = (street, number, tags['addr:postcode'], tags['addr:city'])   # Add later: "addr:district" 
+		index = (street, number, postcode, city)   # Add later: "addr:district" 
 
 		address = {
-			'type': properties['adressplatstyp'],
+			'type': address_type,
 			'tags': tags,
-			'point': (round(point[0], 6), round(point[1], 6)),
+			'point': (round(lon, 6), round(lat, 6)),
 			'index': index
 		}
 		lm_addresses.append(address)
 
+	# Save parsed addresses to cache
+
+	temp_filename = "%s.%i.tmp" % (pickle_filename, os.getpid())
+	file = open(temp_filename, "wb")
+	pickle.dump({ 'key': cache_key, 'addresses': lm_addresses }, file, protocol=pickle.HIGHEST_PROTOCOL)
+	file.close()
+	os.replace(temp_filename, pickle_filename)
+
 	message ("%i\n" % len(lm_addresses))
 
 
 
+# Store OSM elements in compact columns, in the same order.
+# Coordinates of nodes and centers of ways and relations are stored in typed arrays, and tag keys and values are interned.
+# Flags are bits in a bytearray. Nodes and members of ways and relations are kept per position.
+
+clean_flag = 1		# Only address tags
+found_flag = 2		# Matched, no further action
+
+def compact_elements (elements):
+
+	table = {
+		'type': [],
+		'id': array('q'),
+		'lat': array('d'),
+		'lon': array('d'),
+		'version': array('l'),
+		'changeset': array('q'),
+		'uid': array('q'),
+		'user': [],
+		'timestamp': [],
+		'tags': [],
+		'refs': {},
+		'flags': bytearray(len(elements))
+	}
+
+	no_center = { 'lat': math.nan, 'lon': math.nan }
+
+	for i, element in enumerate(elements):
+		point = element if element['type'] == "node" else element.get('center', no_center)
+
+		table['type'].append(sys.intern(element['type']))
+		table['id'].append(element['id'])
+		table['lat'].append(point['lat'])
+		table['lon'].append(point['lon'])
+		table['version'].append(element['version'])
+		table['changeset'].append(element['changeset'])
+		table['uid'].append(element['uid'])
+		table['user'].append(sys.intern(element['user']))
+		table['timestamp'].append(element['timestamp'])
+		table['tags'].append({ sys.intern(key): sys.intern(value) for key, value in element.get('tags', {}).items() })
+
+		if "nodes" in element:
+			table['refs'][ i ] = element['nodes']
+		elif "members" in element:
+			table['refs'][ i ] = element['members']
+
+	return table
+
+
+
+# Return OSM element at position in compact columns, in the same format as returned by Overpass API.
+# Tags are copied and may be modified.
+
+def element_at (table, i):
+
+	element = {
+		'type': table['type'][ i ],
+		'id': table['id'][ i ],
+		'version': table['version'][ i ],
+		'changeset': table['changeset'][ i ],
+		'uid': table['uid'][ i ],
+		'user': table['user'][ i ],
+		'timestamp': table['timestamp'][ i ],
+		'tags': dict(table['tags'][ i ])
+	}
+
+	if element['type'] == "node":
+		element['lat'] = table['lat'][ i ]
+		element['lon'] = table['lon'][ i ]
+	elif element['type'] == "way":
+		element['nodes'] = table['refs'].get(i, [])
+	else:
+		element['members'] = table['refs'].get(i, [])
+
+	return element
+
+
+
+# Wait for background uploads which include any of the loaded OSM elements, unless the loaded OSM data already includes them.
+# Modifying elements from outdated versions would otherwise cause a conflict (HTTP 409) during upload.
+# Returns True if the OSM data must be loaded again.
+# Parameters:
+# - element_ids: Set of (type, id) of loaded OSM elements, compared with ids of upload, or with any ids after resumed upload
+# - osm_base: Overpass timestamp of loaded OSM data
+
+def wait_for_uploads(element_ids, osm_base):
+
+	overlap = [ history for history in upload_history
+				if (history['finished'] is None or osm_base is None or history['finished'] > osm_base)
+					and (history['ids'] is None or not history['ids'].isdisjoint(element_ids)) ]
+
+	if not overlap:
+		return False
+
+	if all(history['finished'] is not None for history in overlap):
+		message ("waiting for Overpass to include uploaded changes... ")
+		time.sleep(upload_wait)
+	else:
+		message ("waiting for background upload of the same elements... ")
+		for history in overlap:
+			history['done'].wait()
+
+	return True
+
+
+
 # Load OSM addresses for one municipality from Overpass
 
 def load_osm_addresses (municipality_id):
 
-	global osm_data				# Address elements downloaded from OSM, sorted by addr:street
+	global osm_elements			# Address elements downloaded from OSM in compact columns
 	global osm_children			# Children elements downloaded from OSM
-	global parents 				# Set of id for parents of osm_data
-	global osm_addr_index 		# Dict with indexes into osm_data
-	global osm_children_index	# Dict with indexes into osm_children
+	global parents 				# Set of id for parents of osm_elements
+	global osm_addr_index 		# Dict with positions in osm_elements per address index
+	global osm_children_index	# Dict with (type, id) index into osm_children
+	global osm_base				# Overpass timestamp of loaded OSM data
 
 	# Load existing addr nodes in OSM for municipality
 
-	message ("Loading existing addresses for %s from OSM Overpass... " % municipalities[ municipality_id ])
+	message ("Loading existing addresses for %s from %s... " % (municipalities[ municipality_id ], "OSM extract" if osm_partitions else "OSM Overpass"))
 
 	query = (	'[out:json][timeout:120];'
 				'(area["ref:scb"=%s][admin_level=7];)->.a;'
 				'(nwr[~"addr:"~".*"](area.a););'
 				'out center meta;' ) % municipality_id
 
-	count = 0
-	osm_data = { 'elements': [] }
-	while not osm_data['elements'] and count < 5:  # Load could be empty from Overpass
-		request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
-		file = open_url(request)
-		osm_data = json.load(file)
-		file.close()
-		count += 1
+	# Load addresses, parents ("recurse up") and children ("recurse down") concurrently, or in one combined query
+
+	queries = [ query, query.replace("out center meta", "<;out meta") ]
+	if not upload or debug:
+		queries.append(query.replace("out center meta", ">;out meta"))
+
+	# Load again from Overpass after waiting if any of the addresses are being uploaded in the background
+
+	tries = 0
+	while True:
+		futures = None
+		if osm_partitions and tries == 0:
+			osm_data, osm_parents, osm_children = get_partition(osm_partitions, municipality_id, children=(not upload or debug))
+		elif osm_snapshot:
+			osm_data, osm_parents, osm_children = load_overpass_snapshot(query, municipality_id, children=(not upload or debug))
+		elif overpass_combined:
+			osm_data, osm_parents, osm_children = load_overpass_combined(query, children=(not upload or debug))
+		else:
+			executor = ThreadPoolExecutor(max_workers=overpass_slots)
+			futures = [ executor.submit(load_overpass, queries[0], retry_empty=True) ]
+			futures.extend([ executor.submit(load_overpass, parent_child_query) for parent_child_query in queries[1:] ])
+			executor.shutdown(wait=False)
+			osm_data = futures[0].result()
+
+		osm_base = osm_data.get('osm3s', {}).get('timestamp_osm_base')
+		if not wait_for_uploads(set((element['type'], element['id']) for element in osm_data['elements']), osm_base):
+			break
+
+		tries += 1
+		if tries > max_upload_waits:
+			message ("\n")
+			sys.exit("*** Uploaded changes are still not available from Overpass, please run again later\n")
 
 	# Create index to speed up matching later
 
+	osm_elements = compact_elements(osm_data['elements'])
+	flags = osm_elements['flags']
+
 	osm_addr_index = dict()
-	osm_addr_ids = set()
+	osm_addr_ids = set(zip(osm_elements['type'], osm_elements['id']))
 
-	for element in osm_data['elements']:
-		tags = element['tags']
-		osm_addr_ids.add(element['id'])
+	for i, tags in enumerate(osm_elements['tags']):
 		index = [None, None, None, None]
 
 		if "addr:street" in tags:
@@ -399,33 +963,30 @@ def load_osm_addresses (municipality_id):
 
 		if index != [None, None, None, None]:
 			index = tuple(index)
-			osm_addr_index[ index ] = element
+			osm_addr_index[ index ] = i
 
 	# Set "clean" flag if only relevant "addr:" tags, and no other tags
 
-	for element in osm_data['elements']:
-		if element['type'] == "node":
+	for i, tags in enumerate(osm_elements['tags']):
+		if osm_elements['type'][ i ] == "node":
 			addr_count = 0
 			clean = True
 
-			for tag in element['tags']:
+			for tag in tags:
 				if tag in ["addr:street", "addr:place", "addr:housenumber", "addr:district", "addr:postcode", "addr:city"]:
 					addr_count += 1
 				elif tag[0:5] != "addr:" and "fixme" not in tag.lower() and "source" not in tag and tag != "created_by":
 					clean = False
 
 			if clean and addr_count > 0:
-				element['clean'] = True
+				flags[ i ] |= clean_flag
 
 	message ("%i" % (len(osm_data['elements'])))
 
 	# Recurse up to get any parents
 
-	query = query.replace("out center meta", "<;out meta")
-	request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
-	file = open_url(request)
-	osm_parents = json.load(file)
-	file.close()
+	if futures:
+		osm_parents = futures[1].result()
 
 	parents = set()  # Will contain the id for children elements
 
@@ -443,19 +1004,16 @@ def load_osm_addresses (municipality_id):
 	# Recurse down to get any childen
 
 	if not upload or debug:
-		query = query.replace("<;out meta", ">;out meta")
-		request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
-		file = open_url(request)
-		osm_children = json.load(file)
-		file.close()
+		if futures:
+			osm_children = futures[2].result()
 		message (" +%i child objects" % (len(osm_children['elements'])))
 
 		# Generate index to children for faster access
 
 		osm_children_index = dict()
 		for element in osm_children['elements']:
-			if element['id'] not in osm_addr_ids:
-				osm_children_index[ element['id'] ] = element
+			if (element['type'], element['id']) not in osm_addr_ids:
+				osm_children_index[ (element['type'], element['id']) ] = element
 
 	else:
 		osm_children = { 'elements': [] }
@@ -467,10 +1025,10 @@ def load_osm_addresses (municipality_id):
 
 # Return osm child/member object in "recurse down" list from Overpass
 
-def child_element (id_no):
+def child_element (element_type, id_no):
 
-	if id_no in osm_children_index:
-		return osm_children_index[ id_no ]
+	if (element_type, id_no) in osm_children_index:
+		return osm_children_index[ (element_type, id_no) ]
 	else:
 		return None
 
@@ -497,14 +1055,14 @@ def generate_element (element, action):
 		if "nodes" in element:
 			for node_ref in element['nodes']:
 				osm_element.append(ET.Element("nd", ref=str(node_ref)))
-				generate_element(child_element(node_ref), action="output")
+				generate_element(child_element("node", node_ref), action="output")
 
 	elif element['type'] == "relation":
 		osm_element = ET.Element("relation")
 		if "members" in element:
 			for member in element['members']:
 				osm_element.append(ET.Element("member", type=member['type'], ref=str(member['ref']), role=member['role']))
-				generate_element(child_element(member['ref']), action="output")
+				generate_element(child_element(member['type'], member['ref']), action="output")
 
 	if "tags" in element:
 		for key, value in iter(element['tags'].items()):
@@ -525,17 +1083,37 @@ def generate_element (element, action):
 	if action == "delete":
 		osm_element.append(ET.Element("tag", k="DELETE", v="yes"))  # Display in JOSM
 
-	osm_root.append(osm_element)
-
 	if action != "output":
 		uploaded += 1
 		osm_element.set('action', "modify")  # Override action for XML file
-		if upload:
-			action_element = ET.Element(action)
-			action_element.append(osm_element)
-			upload_root.append(action_element)
-			if action in ["create", "delete"] and save_new_deleted:
-				save_root.append(osm_element)
+
+	write_osm_element(osm_file, osm_element)
+
+	if action != "output" and upload:
+
+		# Do not upload if object has already been modified or deleted in this upload session (objects across municipality border)
+		if action != "create" and not check_upload(element['type'], element['id'], action):
+			return
+
+		action_element = ET.Element(action)
+		action_element.append(osm_element)
+		upload_root.append(action_element)
+
+
+
+# Register action for existing element in upload session.
+# Returns False if element has already been queued for upload.
+
+def check_upload (element_type, element_id, action):
+
+	upload_id = (element_type, element_id)
+	if upload_id in upload_ids:
+		if upload_ids[ upload_id ] != action:
+			message ("\n\t*** Conflict: %s %i already queued for %s, skipping %s\n" % (element_type, element_id, upload_ids[ upload_id ], action))
+		return False
+
+	upload_ids[ upload_id ] = action
+	return True
 
 
 
@@ -546,7 +1124,6 @@ def merge_addresses (municipality_id):
 	global osm_id 		# Last OSM id generated (negative numbers)
 	global uploaded 	# Number of elements to be uploaded
 
-	validated = 0
 	matched = 0
 	added = 0
 	modified = 0
@@ -558,62 +1135,68 @@ def merge_addresses (municipality_id):
 
 	# 1st pass:
 
-	# Update all clean direct matches betweem Lantmäteriet and OSM
+	# Update all clean direct matches betweem Lantmäteriet and OSM.
+	# Relocation distances are computed for all direct matches in one vectorised operation.
 
-	for lm_addr in lm_addresses:
+	validated = len(lm_addresses)
 
-		validated += 1
+	flags = osm_elements['flags']
 
-		if lm_addr['index'] not in osm_addr_index:  # No direct mnatch
-			continue
+	matches = []
+	for lm_addr in lm_addresses:
+		if lm_addr['index'] in osm_addr_index and flags[ osm_addr_index[ lm_addr['index'] ] ] & clean_flag:
+			matches.append((lm_addr, osm_addr_index[ lm_addr['index'] ]))
 
-		osm_object = osm_addr_index[ lm_addr['index'] ]
+	distances = compute_distances([ lm_addr['point'] for lm_addr, i in matches ],
+									[ (osm_elements['lon'][ i ], osm_elements['lat'][ i ]) for lm_addr, i in matches ])
 
-		if "clean" in osm_object:
-			distance = compute_distance(lm_addr['point'], (osm_object['lon'], osm_object['lat']))
+	for (lm_addr, i), distance in zip(matches, distances.tolist()):
 
-			if distance < 200:  # Avoid large gaps, even for direct hits
+		if flags[ i ] & found_flag:  # Already updated by another address with same index
+			distance = compute_distance(lm_addr['point'], (osm_elements['lon'][ i ], osm_elements['lat'][ i ]))
 
-				# Modify object coordinates if it has been relocated more than 1 meter.
+		if distance < 200:  # Avoid large gaps, even for direct hits
 
-				if distance > min_relocation:
-					new_object = {
-						'type': 'node',
-						'lat': lm_addr['point'][1],
-						'lon': lm_addr['point'][0],
-						'tags': lm_addr['tags']
-					}
+			# Modify object coordinates if it has been relocated more than 1 meter.
 
-					# Keep the existing node if it has a parent and create a new address node.
+			if distance > min_relocation:
+				new_object = {
+					'type': 'node',
+					'lat': lm_addr['point'][1],
+					'lon': lm_addr['point'][0],
+					'tags': lm_addr['tags']
+				}
 
-					if osm_object['id'] in parents:
-						osm_object['tags'] = {}
-						generate_element (osm_object, action="modify")  # Keep empty node if parents
-						modified += 1
+				# Keep the existing node if it has a parent and create a new address node.
 
-						generate_element (new_object, action="create")  # Create new addr node
-						added += 1
+				if osm_elements['id'][ i ] in parents:
+					osm_elements['tags'][ i ] = {}
+					generate_element (element_at(osm_elements, i), action="modify")  # Keep empty node if parents
+					modified += 1
 
-					else:
-						osm_object['tags'] = lm_addr['tags']
-						osm_object['lat'] = lm_addr['point'][1]
-						osm_object['lon'] = lm_addr['point'][0]
-						generate_element (osm_object, action="modify")
-						modified += 1
+					generate_element (new_object, action="create")  # Create new addr node
+					added += 1
 
 				else:
-					if osm_object['tags'] != lm_addr['tags']:  # Ensure correct tagging
-						osm_object['tags'] = lm_addr['tags']
-						generate_element (osm_object, action="modify")
-						modified += 1
-					else: 
-						generate_element (osm_object, action="output")
+					osm_elements['tags'][ i ] = lm_addr['tags']
+					osm_elements['lat'][ i ] = lm_addr['point'][1]
+					osm_elements['lon'][ i ] = lm_addr['point'][0]
+					generate_element (element_at(osm_elements, i), action="modify")
+					modified += 1
+
+			else:
+				if osm_elements['tags'][ i ] != lm_addr['tags']:  # Ensure correct tagging
+					osm_elements['tags'][ i ] = lm_addr['tags']
+					generate_element (element_at(osm_elements, i), action="modify")
+					modified += 1
+				else: 
+					generate_element (element_at(osm_elements, i), action="output")
 
-				# Mark match as found and for no further action
+			# Mark match as found and for no further action
 
-				osm_object['found'] = True
-				lm_addr['found'] = True
-				matched += 1
+			flags[ i ] |= found_flag
+			lm_addr['found'] = True
+			matched += 1
 
 
 	# 2nd pass:
@@ -622,12 +1205,10 @@ def merge_addresses (municipality_id):
 	# "Clean" address node are nodes which contain all of addr:street/addr:place, addr:housenumber, addr:postcode, addr:city and no other tags.
 	# Remaining non-matched Lantmäteriet addresses are output as new address nodes.
 
-	# Create shorter list of OSM matching candidates to speed up iterations
+	# Create index of OSM matching candidates per house number and location to speed up iterations
 
-	osm_addr_elements = []
-	for osm_object in osm_data['elements']:
-		if "clean" in osm_object and "found" not in osm_object:
-			osm_addr_elements.append(osm_object)
+	positions = [ i for i in range(len(flags)) if flags[ i ] & clean_flag and not flags[ i ] & found_flag ]
+	grid = build_grid(osm_elements, positions, max_relocation)
 
 	# Loop remaining Lantmäteriet addresses
 
@@ -644,19 +1225,13 @@ def merge_addresses (municipality_id):
 		# Loop existing OSM addr objects to find best close match with "pure" address node, to be modified.
 		# House number is required to match, to avoid strange node history.
 
-		best_distance = max_relocation  # Minimum meters distance
 		found = False
 
-		for osm_object in osm_addr_elements:
-			if ("found" not in osm_object
-					and "addr:housenumber" in osm_object['tags']
-					and osm_object['tags']['addr:housenumber'].replace(" ", "").upper() == lm_addr['tags']['addr:housenumber']):
-
-				distance = compute_distance(lm_addr['point'], (osm_object['lon'], osm_object['lat']))
-				if distance < best_distance:
-					keep_object = osm_object
-					best_distance = distance
-					found = True
+		if "addr:housenumber" in lm_addr['tags']:
+			found_index = grid_nearest(grid, lm_addr['tags']['addr:housenumber'], lm_addr['point'])
+			if found_index is not None:
+				grid_remove(grid, osm_elements, found_index)
+				found = True
 
 		# Output new addr node to file if no match, or modified addr node if close location match
 		
@@ -668,21 +1243,21 @@ def merge_addresses (municipality_id):
 		}
 
 		if found:
-			if keep_object['id'] in parents:
-				keep_object['tags'] = {}
-				generate_element (keep_object, action="modify")  # Keeo empty node if parents
+			if osm_elements['id'][ found_index ] in parents:
+				osm_elements['tags'][ found_index ] = {}
+				generate_element (element_at(osm_elements, found_index), action="modify")  # Keeo empty node if parents
 				modified += 1
 
 				generate_element (new_object, action="create")  # Create new addr node
 				added += 1
 			else:
-				keep_object['tags'] = lm_addr['tags']
-				keep_object['lat'] = lm_addr['point'][1]
-				keep_object['lon'] = lm_addr['point'][0]
-				generate_element (keep_object, action="modify")
+				osm_elements['tags'][ found_index ] = lm_addr['tags']
+				osm_elements['lat'][ found_index ] = lm_addr['point'][1]
+				osm_elements['lon'][ found_index ] = lm_addr['point'][0]
+				generate_element (element_at(osm_elements, found_index), action="modify")
 				modified += 1
 
-			keep_object['found'] = True
+			flags[ found_index ] |= found_flag
 
 		else:
 			generate_element (new_object, action="create")
@@ -695,14 +1270,16 @@ def merge_addresses (municipality_id):
 	# Delete remaining "clean" addr nodes (they did not match).
 	# Remove addr tags from ways and relations (addr tags will be on separate addr nodes), except certain addr keys.
 
-	for osm_object in osm_data['elements']:
+	for i in range(len(flags)):
 
-		if "found" in osm_object:
+		if flags[ i ] & found_flag:
 			continue
 
+		osm_object = element_at(osm_elements, i)
+
 		# Delete remaining "clean" address node (without other tags)
 
-		if "clean" in osm_object:
+		if flags[ i ] & clean_flag:
 			if osm_object['id'] in parents:
 				osm_object['tags'] = {}
 				generate_element (osm_object, action="modify")  # Keep empty node if parents
@@ -784,89 +1361,412 @@ def indent_tree(elem, level=0):
 
 
 
-# Create XML roots, to be output later
+# Create XML roots, to be output later.
+# OSM file is streamed to a temporary file which is kept or discarded by upload_changeset().
+# Parameter:
+# - stream: If False, elements are only collected in memory (worker processes)
 
-def init_root():
+def init_root(stream=True):
 
-	global osm_root		# XML of all addresses in municipality
+	global osm_file		# Streamed OSM file of all addresses in municipality/county
 	global upload_root	# XML to be uploaded to OSM
-	global save_root 	# XML of all deleted addresses during run
+	global upload_ids	# Dict with action per (type, id) of existing elements in upload_root
+
+	if "osm_file" in globals():
+		close_osm_file(osm_file)  # Discard if not saved by upload_changeset()
 
-	osm_root = ET.Element("osm", version="0.6", generator="addr2osm v%s" % version, upload="false")
+	if stream:
+		osm_file = open_osm_file("adresse.%i.tmp" % os.getpid())
+	else:
+		osm_file = open_osm_file()
 	upload_root = ET.Element("osmChange", version="0.6", generator="nsr2osm")
-	if "save_root" not in globals():
-		save_root = ET.Element("osm", version="0.6", generator="addr2osm v%s" % version, upload="false")
+	upload_ids = dict()
 
 
 
-# Upload changeset to OSM
+# Open OSM file for writing elements one by one as they are generated.
+# Output is identical to ElementTree.write() of a complete tree after indent_tree().
+# Without filename, elements are only collected in the 'elements' list.
 
-def upload_changeset(entity_id, entity_name, changeset_count):
+def open_osm_file (filename=None):
 
-	if upload and changeset_count > 0:
+	osm_file = {
+		'filename': filename,
+		'file': None,
+		'elements': [],
+		'count': 0,
+		'header': ET.tostring(ET.Element("osm", version="0.6", generator="addr2osm v%s" % version, upload="false"), encoding="unicode")
+	}
 
-		if changeset_count < 9900:  # Maximum upload is 10.000 elements
-			
-			today_date = time.strftime("%Y-%m-%d", time.localtime())
+	if filename:
+		osm_file['file'] = open(filename, "w", encoding="utf-8", errors="xmlcharrefreplace")
+		osm_file['file'].write("<?xml version='1.0' encoding='utf-8'?>\n")
 
-			changeset_root = ET.Element("osm")
-			changeset_element = ET.Element("changeset")
-			changeset_element.append(ET.Element("tag", k="comment", v="Address import update for %s" % entity_name))
-			changeset_element.append(ET.Element("tag", k="source", v="Lantmäteriet Belägenhetsadress"))
-			changeset_element.append(ET.Element("tag", k="source:date", v=today_date))
-			changeset_root.append(changeset_element)
-			changeset_xml = ET.tostring(changeset_root, encoding='utf-8', method='xml')
+	return osm_file
 
-			request = urllib.request.Request(osm_api + "changeset/create", data=changeset_xml, headers=osm_request_header, method="PUT")
-			file = open_url(request)  # Create changeset
-			changeset_id = file.read().decode()
-			file.close()	
 
-			message ("Uploading %i elements for %s to OSM in changeset #%s... " % (changeset_count, entity_name, changeset_id))
 
-			for element in upload_root:
-				element[0].set("changeset", changeset_id)  # Update changeset for element
+# Write one OSM element to OSM file, or collect it if no file.
 
-			indent_tree(upload_root)
-			changeset_xml = ET.tostring(upload_root, encoding='utf-8', method='xml')
+def write_osm_element (osm_file, osm_element):
 
-			request = urllib.request.Request(osm_api + "changeset/%s/upload" % changeset_id, data=changeset_xml, headers=osm_request_header)
-			file = open_url(request)  # Post changeset in one go
-			file.close()
+	if osm_file['file'] is None:
+		osm_file['elements'].append(osm_element)
+		return
 
-			request = urllib.request.Request(osm_api + "changeset/%s/close" % changeset_id, headers=osm_request_header, method="PUT")
-			file = open_url(request)  # Close changeset
-			file.close()
+	if not osm_file['count']:
+		osm_file['file'].write(osm_file['header'][:-3] + ">")  # Open root element
 
-			if debug:
-				file_out = open("addr_changeset.xml", "w")
-				file_out.write(changeset_xml.decode())
-				file_out.close()
+	indent_tree(osm_element, level=1)
+	osm_element.tail = None
+	osm_file['file'].write("\n  " + ET.tostring(osm_element, encoding="unicode"))
+	osm_file['count'] += 1
 
-			message ("Done\n")
-			return True
 
-		else:
-			message ("\n\nCHANGESET TOO LARGE (%i) - UPLOAD MANUALLY WITH JOSM\n\n" % changeset_count)
-			not_uploaded.append("%s %s" % (entity_id, entity_name))
 
-	if not upload and changeset_count > 0 or upload and changeset_count >= 9900 or debug:
-		osm_tree = ET.ElementTree(osm_root)
-		indent_tree(osm_root)
+# Close OSM file and save it with given filename, or discard it if no filename.
+
+def close_osm_file (osm_file, filename=None):
+
+	if osm_file['file'] is None or osm_file['file'].closed:
+		return
+
+	if osm_file['count']:
+		osm_file['file'].write("\n</osm>\n")
+	else:
+		osm_file['file'].write(osm_file['header'])
+	osm_file['file'].close()
+
+	if filename:
+		os.replace(osm_file['filename'], filename)
+	else:
+		os.remove(osm_file['filename'])
+
+
+
+# Discard streamed OSM files which were not saved when the program stops, including after errors and Ctrl-C.
+# Registered with atexit by the main program.
+
+def remove_temporary_files():
+
+	for name in ["osm_file", "save_file"]:
+		if name in globals():
+			close_osm_file(globals()[ name ])
+
+
+
+# Write new and deleted elements of upload session to file with all new and deleted addresses during run
+
+def write_new_deleted(action_elements):
+
+	if save_new_deleted:
+		for action_element in action_elements:
+			if action_element.tag in ["create", "delete"]:
+				write_osm_element(save_file, action_element[0])
+
+
+
+# Upload changeset to OSM.
+# Changes are split into several changesets of max_changeset_size elements, in dependency order (create, modify, delete).
+# Upload is done by upload_worker() in background, while the next county/municipality is processed.
+# Parts not yet uploaded are kept in resume file, to be uploaded by resume_upload() if the upload is interrupted.
+
+def upload_changeset(entity_id, entity_name, changeset_count):
+
+	global upload_thread
+
+	if upload and changeset_count > 0:
+
+		action_elements = list(upload_root)
+		if len(action_elements) > max_changeset_size:  # Keep original order if only one part
+			action_order = {"create": 0, "modify": 1, "delete": 2}
+			action_elements.sort(key=lambda action_element: action_order[ action_element.tag ])
+
+		parts = []
+		for i in range(0, len(action_elements), max_changeset_size):
+			part_root = ET.Element("osmChange", version="0.6", generator="nsr2osm")
+			part_root.extend(action_elements[ i : i + max_changeset_size ])
+			indent_tree(part_root)
+			parts.append(part_root)
+
+		job = {
+			'entity_id': entity_id,
+			'entity_name': entity_name,
+			'parts': len(parts),
+			'changeset': None,  # Open changeset of first part while it is being uploaded
+			'changes': [ ET.tostring(part_root, encoding='unicode', method='xml') for part_root in parts ]
+		}
+
+		with upload_lock:
+			pending_uploads.append(job)
+			save_resume()
+
+		history = {
+			'ids': set((action_element[0].tag, int(action_element[0].get('id')))
+						for action_element in upload_root if action_element.tag != "create"),
+			'finished': None,  # UTC time when upload ended
+			'done': threading.Event()
+		}
+		upload_history.append(history)
+
+		close_osm_file(osm_file)
+
+		if upload_thread is None:
+			upload_thread = threading.Thread(target=upload_worker)
+			upload_thread.start()
+		upload_queue.put((job, parts, upload_root, history))  # Waits if queue is full
+		return True
+
+	if not upload and changeset_count > 0 or debug:
 		out_filename = "adresse_%s_%s.osm" % (entity_id, entity_name)
 		out_filename = out_filename.replace(" ", "_")
-		osm_tree.write(out_filename, encoding="utf-8", method="xml", xml_declaration=True)
+		close_osm_file(osm_file, out_filename)
 		message ("Saved %i updates to file '%s'\n" % (changeset_count, out_filename))
+	else:
+		close_osm_file(osm_file)
 
 	return False
 
 
 
+# Upload first part of changes not yet uploaded for job to OSM in a new changeset.
+# The changeset id is kept in the resume file during upload, and the part is removed from the resume file right after upload.
+# Parameters:
+# - job: Dict with entity name, total number of parts and XML of parts not yet uploaded, as saved in resume file
+# - part_root: osmChange XML of first part not yet uploaded
+
+def upload_part(job, part_root):
+
+	entity_name = job['entity_name']
+	parts = job['parts']
+	part = parts - len(job['changes']) + 1
+
+	today_date = time.strftime("%Y-%m-%d", time.localtime())
+
+	comment = "Address import update for %s" % entity_name
+	if parts > 1:
+		comment += " (part %i of %i)" % (part, parts)
+
+	changeset_root = ET.Element("osm")
+	changeset_element = ET.Element("changeset")
+	changeset_element.append(ET.Element("tag", k="comment", v=comment))
+	changeset_element.append(ET.Element("tag", k="source", v="Lantmäteriet Belägenhetsadress"))
+	changeset_element.append(ET.Element("tag", k="source:date", v=today_date))
+	changeset_root.append(changeset_element)
+	changeset_xml = ET.tostring(changeset_root, encoding='utf-8', method='xml')
+
+	request = urllib.request.Request(osm_api + "changeset/create", data=changeset_xml, headers=osm_request_header, method="PUT")
+	file = open_url(request)  # Create changeset
+	changeset_id = file.read().decode()
+	file.close()	
+
+	with upload_lock:
+		job['changeset'] = changeset_id
+		save_resume()
+
+	if parts > 1:
+		message ("Uploading %i elements for %s (part %i of %i) to OSM in changeset #%s... " % (len(part_root), entity_name, part, parts, changeset_id))
+	else:
+		message ("Uploading %i elements for %s to OSM in changeset #%s... " % (len(part_root), entity_name, changeset_id))
+
+	for element in part_root:
+		element[0].set("changeset", changeset_id)  # Update changeset for element
+
+	indent_tree(part_root)
+	changeset_xml = ET.tostring(part_root, encoding='utf-8', method='xml')
+
+	request = urllib.request.Request(osm_api + "changeset/%s/upload" % changeset_id, data=changeset_xml, headers=osm_request_header)
+	file = open_url(request)  # Post changeset in one go
+	file.close()
+
+	with upload_lock:
+		remove_part(job)
+
+	close_changeset(changeset_id)
+
+	if debug:
+		file_out = open("addr_changeset.xml", "w")
+		file_out.write(changeset_xml.decode())
+		file_out.close()
+
+	message ("Done\n")
+
+
+
+# Close changeset in OSM.
+
+def close_changeset(changeset_id):
+
+	request = urllib.request.Request(osm_api + "changeset/%s/close" % changeset_id, headers=osm_request_header, method="PUT")
+	file = open_url(request)  # Close changeset
+	file.close()
+
+
+
+# Remove first part of job from resume file after it has been uploaded.
+# Must be called with upload_lock.
+
+def remove_part(job):
+
+	job['changes'].pop(0)
+	job['changeset'] = None
+	if not job['changes']:
+		pending_uploads.remove(job)
+	save_resume()
+
+
+
+# Upload remaining parts of one upload job.
+# Stops if the main program has ended or crashed, and returns False. Remaining parts are kept in resume file.
+# Parameters:
+# - job: Dict with entity name, total number of parts and XML of parts not yet uploaded, as saved in resume file
+# - parts: osmChange XML of parts not yet uploaded
+
+def upload_job(job, parts):
+
+	while parts:
+		if not threading.main_thread().is_alive():
+			return False
+		upload_part(job, parts.pop(0))
+
+	return True
+
+
+
+# Upload jobs from upload queue in background thread.
+# After a failed upload, remaining jobs are only kept in resume file.
+# Stops at end of queue, or when main program has ended or crashed (e.g. KeyboardInterrupt). Jobs not uploaded are kept in resume file.
+# The upload history of each job is marked as finished for wait_for_uploads().
+
+def upload_worker():
+
+	global upload_error
+
+	while threading.main_thread().is_alive():
+		try:
+			item = upload_queue.get(timeout=1)
+		except queue.Empty:
+			continue
+
+		if item is None:
+			break
+
+		job, parts, action_elements, history = item
+		try:
+			if upload_error is None:
+				try:
+					if upload_job(job, parts):
+						write_new_deleted(action_elements)
+				except SystemExit:  # Error message already given by open_url()
+					upload_error = job['entity_name']
+				except Exception as e:
+					message ("\n*** Upload error: %s\n" % str(e))
+					upload_error = job['entity_name']
+
+			if upload_error is not None:
+				not_uploaded.append("%s %s" % (job['entity_id'], job['entity_name']))
+
+		finally:
+			history['finished'] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+			history['done'].set()
+
+
+
+# Wait for background upload to finish, and report counties/municipalities not uploaded.
+
+def finish_uploads():
+
+	if upload_thread is not None:
+		upload_queue.put(None)
+		upload_thread.join()
+
+	if not_uploaded:
+		message ("\n*** Upload of %s failed. %i changesets not uploaded are saved in '%s' and will be uploaded when restarting with -upload\n"
+					% (upload_error, sum(len(job['changes']) for job in pending_uploads), resume_filename))
+		message ("Counties/municipalities not uploaded (use -discard to drop them instead):\n")
+		for line in not_uploaded:
+			message ("\t%s\n" % line)
+		message ("\n")
+
+
+
+# Save parts of changes not yet uploaded to resume file, or remove resume file when all parts have been uploaded.
+# Must be called with upload_lock.
+
+def save_resume():
+
+	if pending_uploads:
+		tmp_filename = resume_filename + ".%i.tmp" % os.getpid()
+		file = open(tmp_filename, "w", encoding="utf-8")
+		json.dump(pending_uploads, file, ensure_ascii=False)
+		file.close()
+		os.replace(tmp_filename, resume_filename)
+
+	elif os.path.isfile(resume_filename):
+		os.remove(resume_filename)
+
+
+
+# Check changeset of a part which was being uploaded when the upload was interrupted.
+# Diff uploads are atomic, so the part has been uploaded if the changeset contains changes. The changeset is closed if still open.
+
+def check_changeset(job):
+
+	changeset_id = job['changeset']
+	request = urllib.request.Request(osm_api + "changeset/%s" % changeset_id, headers=osm_request_header)
+	file = open_url(request)
+	changeset_element = ET.parse(file).getroot().find("changeset")
+	file.close()
+
+	if changeset_element.get("open") == "true":
+		close_changeset(changeset_id)
+
+	with upload_lock:
+		if int(changeset_element.get("changes_count", "0")) > 0:
+			message ("Part of %s was already uploaded in changeset #%s\n" % (job['entity_name'], changeset_id))
+			remove_part(job)
+		else:
+			job['changeset'] = None
+			save_resume()
+
+
+
+# Upload remaining parts from resume file after an interrupted upload.
+# Must be done before new changes are generated from OSM data.
+# OSM data is then loaded again until Overpass includes the resumed changes, by wait_for_uploads().
+
+def resume_upload():
+
+	file = open(resume_filename, encoding="utf-8")
+	pending_uploads.extend(json.load(file))
+	file.close()
+
+	resumed = False
+	for job in list(pending_uploads):
+		if job.get('changeset'):
+			check_changeset(job)
+			resumed = True
+		if job['changes']:
+			message ("Resuming interrupted upload of %i remaining part(s) for %s\n" % (len(job['changes']), job['entity_name']))
+			upload_job(job, [ ET.fromstring(changes) for changes in job['changes'] ])
+			resumed = True
+
+	# Ids of new elements are not known, so all OSM data must include the resumed changes before it is used
+
+	if resumed:
+		history = { 'ids': None, 'finished': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), 'done': threading.Event() }
+		history['done'].set()
+		upload_history.append(history)
+
+	message ("\n")
+
+
+
 # Load addresses and update OSM addresses with Lantmäteriet for one municipality
 
 def process_municipality (municipality_id):
 
-	global osm_data
+	global osm_elements
 	global osm_addr_index
 
 	# Load addresses from Lantmäteriet and OSM
@@ -879,7 +1779,7 @@ def process_municipality (municipality_id):
 	if not source:
 		load_osm_addresses(municipality_id)
 	else:
-		osm_data = { 'elements': [] }
+		osm_elements = compact_elements([])
 		osm_addr_index = {}
 
 	# Match and merge
@@ -891,6 +1791,99 @@ def process_municipality (municipality_id):
 
 
 
+# Set up global data in worker process for concurrent processing of municipalities
+
+def init_worker (worker_data):
+
+	global municipalities, counties, lm_token, source, upload, overpass_semaphore
+	global upload_history
+
+	municipalities, counties, lm_token, source, upload, overpass_semaphore = worker_data
+	upload_history = []  # Background uploads are checked by merge_municipality() in main process
+
+
+
+# Process one municipality in worker process.
+# Returns generated elements, counter and screen output, to be merged by merge_municipality() in main process.
+# New elements get negative id from -1 and are renumbered when merged.
+
+def process_worker (task):
+
+	global osm_id, osm_base, osm_partitions
+
+	municipality_id, osm_partitions = task  # Only the partition of the municipality is passed to the worker
+
+	osm_id = 0
+	osm_base = None
+	init_root(stream=False)
+
+	result = { 'municipality': municipality_id }
+	stdout = sys.stdout
+	sys.stdout = io.StringIO()
+
+	try:
+		process_municipality(municipality_id)
+	except SystemExit as e:  # Fatal error in open_url() etc
+		result['error'] = str(e.code) if e.code else ""
+	finally:
+		result['output'] = sys.stdout.getvalue()
+		sys.stdout = stdout
+
+	if "error" not in result:
+		result.update({
+			'osm_id': osm_id,
+			'uploaded': uploaded,
+			'osm_base': osm_base,
+			'osm_root': osm_file['elements'],
+			'upload_root': list(upload_root)
+		})
+
+	return result
+
+
+
+# Merge result from process_worker() into XML roots of main process, in the same order as sequential processing.
+# New element ids are renumbered to continue from osm_id, and elements already in upload session are skipped.
+
+def merge_municipality (result):
+
+	global osm_id, uploaded
+
+	message (result['output'])
+	if "error" in result:
+		pool.terminate()
+		sys.exit(result['error'])
+
+	# Process again in main process if elements were loaded before being uploaded in the background
+
+	element_ids = set((action_element[0].tag, int(action_element[0].get('id')))
+						for action_element in result['upload_root'] if action_element.tag != "create")
+	if wait_for_uploads(element_ids, result['osm_base']):
+		message ("processing again\n")
+		process_municipality(result['municipality'])
+		return
+
+	# Renumber new elements (same element may be shared between roots)
+
+	renumbered = set()
+	for element in result['osm_root'] + [ action_element[0] for action_element in result['upload_root'] ]:
+		if id(element) not in renumbered and int(element.get('id')) < 0:
+			element.set('id', str(osm_id + int(element.get('id'))))
+			renumbered.add(id(element))
+
+	osm_id += result['osm_id']
+
+	for element in result['osm_root']:
+		write_osm_element(osm_file, element)
+	for action_element in result['upload_root']:
+		element = action_element[0]
+		if action_element.tag == "create" or check_upload(element.tag, int(element.get('id')), action_element.tag):
+			upload_root.append(action_element)
+
+	uploaded = result['uploaded']
+
+
+
 # Main program
 
 if __name__ == '__main__':
@@ -907,7 +1900,28 @@ if __name__ == '__main__':
 	if len(sys.argv) > 1:
 		entity = get_municipality(sys.argv[1])
 	else:
-		sys.exit ("Please provide name of municipality, county og 'Sverige' + optional '-upload' or '-source'\n\n")
+		sys.exit ("Please provide name of municipality, county og 'Sverige' + optional '-upload' or '-source', '-jobs <n>', '-pbf <file>', '-country' and '-discard'\n\n")
+
+	if "-country" in sys.argv and entity != "00":  # Overpass query would load the entire country anyway
+		sys.exit ("Please use '-country' only for the entire country ('Sverige')\n\n")
+
+	jobs = 1  # Number of municipalities processed concurrently
+	if "-jobs" in sys.argv:
+		index = sys.argv.index("-jobs") + 1
+		if index < len(sys.argv) and sys.argv[ index ].isdigit() and int(sys.argv[ index ]) > 0:
+			jobs = int(sys.argv[ index ])
+		else:
+			sys.exit ("Please provide number of concurrent municipalities after '-jobs'\n\n")
+
+	overpass_semaphore = multiprocessing.Semaphore(overpass_slots)  # Limits concurrent Overpass queries of all jobs
+
+	pbf_filename = None  # Local OSM extract instead of Overpass
+	if "-pbf" in sys.argv:
+		index = sys.argv.index("-pbf") + 1
+		if index < len(sys.argv) and os.path.isfile(sys.argv[ index ]):
+			pbf_filename = sys.argv[ index ]
+		else:
+			sys.exit ("Please provide OSM extract file after '-pbf'\n\n")
 
 	lm_token = get_lm_token()
 
@@ -915,23 +1929,51 @@ if __name__ == '__main__':
 
 	source = ("-source") in sys.argv  # Only output LM source data
 	upload = False
+
+	upload_queue = queue.Queue(maxsize=upload_queue_size)  # Changesets for background upload
+	upload_lock = threading.Lock()  # Lock for pending_uploads and resume file
+	upload_thread = None
+	upload_error = None  # Entity name of failed upload
+	pending_uploads = []  # Parts not yet uploaded, as saved in resume file
+	not_uploaded = []  # Counties/municipalities not uploaded because of failed upload
+	upload_history = []  # Element ids and end time of each upload job, for wait_for_uploads()
+
+	if "-discard" in sys.argv and os.path.isfile(resume_filename):  # Discard changes not uploaded in resume file
+		os.remove(resume_filename)
+		message ("Discarded changes of interrupted upload in '%s'\n" % resume_filename)
+
 	if not source:
 		upload = ("-upload" in sys.argv)
 		if upload:
 			osm_request_header = get_osm_token()
+			if os.path.isfile(resume_filename):
+				resume_upload()
+
+	# Load OSM addresses for all municipalities from local OSM extract, or from one Overpass query for the entire country
+
+	osm_partitions = None
+	if pbf_filename and not source:
+		osm_partitions = load_pbf(pbf_filename, children=(not upload or debug), boundary_municipality=boundary_municipality)
+	elif "-country" in sys.argv and not source:
+		osm_partitions = load_overpass_country(children=(not upload or debug))
 
 	# Process either one municipality or all municipalities in one county.
 	# Uploading to OSM either per municipality or per county.
 
 	osm_id = -1000
-	not_uploaded = []  # Will contain counties/municipalities not uploaded due to changeset size
 	uploaded = 0
 
+	atexit.register(remove_temporary_files)
+
+	if upload and save_new_deleted:
+		save_file = open_osm_file("new_deleted_addresses.%i.tmp" % os.getpid())  # Streamed file with all new and deleted addresses
+
 	if len(entity) == 4:
 		entity_name = municipalities[ entity ]
 		init_root()
 		process_municipality (entity)
 		upload_changeset(entity, entity_name, uploaded)
+		finish_uploads()
 		message ("\n")
 
 	else:
@@ -944,6 +1986,19 @@ if __name__ == '__main__':
 		municipality_count = 0
 		total_uploaded = 0
 
+		# Start worker processes. Results are merged in the same order as sequential processing.
+
+		if jobs > 1:
+			municipality_ids = [ municipality_id for municipality_id in sorted(municipalities.keys())
+								if len(municipality_id) == 4 and (entity == "00" and municipality_id[0:2] in counties or municipality_id[0:2] == entity)
+									and municipality_id >= first_municipality ]
+			if upload and save_new_deleted:
+				save_file['file'].flush()  # Forked workers must not inherit buffered output
+			pool = multiprocessing.Pool(jobs, initializer=init_worker,
+										initargs=((municipalities, counties, lm_token, source, upload, overpass_semaphore),))
+			results = pool.imap(process_worker, [ (municipality_id, single_partition(osm_partitions, municipality_id))
+													for municipality_id in municipality_ids ])
+
 		for county_id in sorted(counties.keys()):
 			if entity == "00" or county_id == entity:
 				init_root()
@@ -951,7 +2006,10 @@ if __name__ == '__main__':
 
 				for municipality_id in sorted(municipalities.keys()):
 					if len(municipality_id) == 4 and municipality_id[0:2] == county_id and municipality_id >= first_municipality:
-						process_municipality (municipality_id)
+						if jobs > 1:
+							merge_municipality (next(results))
+						else:
+							process_municipality (municipality_id)
 						total_uploaded += uploaded
 						county_uploaded += uploaded
 						municipality_count += 1
@@ -964,20 +2022,19 @@ if __name__ == '__main__':
 					message ("\n\n")
 					upload_changeset(county_id, counties[ county_id ], county_uploaded)
 
+		if jobs > 1:
+			pool.close()
+			pool.join()
+
+		finish_uploads()
+
 		message ("\nDone processing %i municipalities in %s, %i changes\n" % (municipality_count, entity_name, total_uploaded))
 		time_spent = time.time() - total_start_time
 		message ("Total time %i:%02d minutes\n\n" % (time_spent / 60, time_spent % 60))
 
-		if not_uploaded:
-			message ("Upload these counties/municipalities manually (files have been generated):\n")
-			for line in not_uploaded:
-				message ("\t%s\n" % line)
-			message ("\n")
-
 	# Save file with new and deleted addresses (indication of buildings to be modified)
 
+	close_osm_file(osm_file)  # Discard if not saved
+
 	if upload and save_new_deleted:
-		save_tree = ET.ElementTree(save_root)
-		indent_tree(save_root)
-		out_filename = "new_deleted_addresses.osm"
-		save_tree.write(out_filename, encoding="utf-8", method="xml", xml_declaration=True)
+		close_osm_file(save_file, "new_deleted_addresses.osm")